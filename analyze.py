@@ -1,18 +1,46 @@
 import numpy as np
 import params
 import matplotlib.pyplot as plt
+import os
 import sys
 import json
+import argparse
+import traces
+
+parser = argparse.ArgumentParser(description="Plot a queue trace.")
+parser.add_argument('trace', nargs='?', default=None,
+                    help="trace to plot (default: params.trace, or the text trace of the same name if it is missing)")
+parser.add_argument('--start', type=float, default=None, help="first time to plot (s)")
+parser.add_argument('--end', type=float, default=None, help="last time to plot (s)")
+parser.add_argument('--width', type=int, default=None,
+                    help="number of time bins to decimate to (default: the width of the figure in pixels, 0: no decimation)")
+args = parser.parse_args()
+if args.trace is None:
+    args.trace = params.trace
+    if not os.path.exists(args.trace):
+        # e.g. the queue.tr that comes with the repo, from before traces were binary
+        args.trace = os.path.splitext(args.trace)[0] + '.tr'
 
 ################### preprocess trace ##################
-# time byte_size makeups largest_pause_sent packet_drops
-trace_data = np.loadtxt(params.trace, delimiter=params.trace_delim)
+# fields: time byte_size makeup pause drops
+# only what makes it to the screen: the min and max of every field and makeup
+# column in every pixel column, two rows per column, stacked into a span below
+width = args.width
+if width is None:
+    width = int(plt.rcParams['figure.figsize'][0] * plt.rcParams['figure.dpi'])
+if width:
+    trace_data = traces.decimate_trace(args.trace, width, args.start, args.end)
+else:
+    trace_data = traces.load_trace(args.trace)
+    if args.start is not None:
+        trace_data = trace_data[trace_data['time'] >= args.start]
+    if args.end is not None:
+        trace_data = trace_data[trace_data['time'] <= args.end]
 # exp_data = np.loadtxt(params.exp_path + params.exp_trace, delimiter=params.trace_delim)
 
 # ################### plot queue length over time ##################
 # fig = plt.figure()
-# byte_size_offset = 1
-# plt.plot(trace_data[:,0], trace_data[:,byte_size_offset])
+# plt.plot(trace_data['time'], trace_data['byte_size'])
 # for thresh in params.byte_thresholds:
 #     plt.axhline(y=thresh)
 # # axes = plt.gca()
@@ -26,10 +54,9 @@ trace_data = np.loadtxt(params.trace, delimiter=params.trace_delim)
 
 ################# stackplot of queue makeup over time ##################
 fig, axarr = plt.subplots(2, sharex=True)
-makeup_offset = 2
 for thresh in params.byte_thresholds[1::2]:
     axarr[0].axhline(y=thresh, linewidth=1, alpha=0.4)
-axarr[0].stackplot(np.transpose(trace_data[:,0]), np.transpose(trace_data[:,makeup_offset:makeup_offset+len(params.priorities)]))
+axarr[0].stackplot(trace_data['time'], np.transpose(trace_data['makeup']))
 
 # Put a legend to the right of the current axis
 # axarr[0].legend(loc='center left', bbox_to_anchor=(1, 0.5))
@@ -39,8 +66,7 @@ axarr[0].set_ylabel('size (bytes)')
 
 
 ################## plot pause thresholds over time ##################
-pauses_offset = 2 + len(params.priorities)
-axarr[1].plot(trace_data[:,0], trace_data[:,pauses_offset])
+axarr[1].plot(trace_data['time'], trace_data['pause'])
 axarr[1].set_ylim([-2,params.priorities[-1]+1])
 axarr[1].set_title('Pauses sent')
 axarr[1].set_xlabel('time (s)')
@@ -49,8 +75,7 @@ plt.show()
 
 ################### plot drops over time ##################
 # fig = plt.figure()
-# drops_offset = 3 + len(params.priorities)
-# plt.plot(trace_data[:,0], trace_data[:,drops_offset])
+# plt.plot(trace_data['time'], trace_data['drops'])
 # # axes = plt.gca()
 # # axes.set_xlim([0.4, 0.8])
 # # axes.set_ylim([0,100])
@@ -59,6 +84,7 @@ plt.show()
 # plt.ylabel('Drops (packets)')
 # plt.show()
 
+# report.py renders the sweep plots below for every results/exp* directory without a display
 ################### 95th percentile queue size vs number of priority levels ##################
 # fig = plt.figure()
 # percentile_data = exp_data[:,1::2]
@@ -0,0 +1,221 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+import simpy
+import params
+from generate import simulate
+from kernel import Kernel
+from model import Packet, PacketQueue, PrioritySwitchPort, PortMonitor
+
+# Speed benchmarks of the simulator, written to a JSON file so runs on
+# different commits can be compared:
+#
+#   python bench.py [--output bench.json] [--duration 0.1] [--priorities 5 100] [--loads 0.5 0.9] [--engines simpy kernel]
+#   python bench.py --compare old.json new.json
+
+PRIORITIES = [5, 100, 1000, 10000]
+LOADS = [0.5, 0.7, 0.9, 0.99]
+ENGINES = ['simpy', 'kernel']
+
+class CountingEnvironment(simpy.Environment):
+    """ A simpy.Environment that counts the events it processes """
+    def __init__(self, *args, **kwargs):
+        simpy.Environment.__init__(self, *args, **kwargs)
+        self.steps = 0
+
+    def step(self):
+        self.steps += 1
+        simpy.Environment.step(self)
+
+class Discard(object):
+    """ The end of a port under test: throws the packets away """
+    def put(self, pkt):
+        pkt.release()
+
+def peak_rss():
+    """ Returns the peak resident memory of this process in MB """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def bench_simulate(case):
+    """ Times one end-to-end simulate() of (number of priorities, k, sim_duration, batch_arrivals, engine).
+        Meant to run in a fresh process so the peak RSS is its own.
+    """
+    num, k, duration, batch, engine = case
+    config = params.SimulationConfig(num_priorities=num, k=k, sim_duration=duration, batch_arrivals=batch)
+    env = Kernel() if engine == 'kernel' else CountingEnvironment()
+    start = time.time()
+    pm = simulate(config, 0, None, env)
+    wall_time = time.time() - start
+    return {'num_priorities': num,
+            'k': k,
+            'sim_duration': duration,
+            'batch_arrivals': batch,
+            'engine': engine,
+            'wall_time': wall_time,
+            'events': env.steps,
+            'events_per_sec': env.steps / wall_time,
+            'packets': pm.port.packets_rec,
+            'packets_per_sec': pm.port.packets_rec / wall_time,
+            'peak_rss_mb': peak_rss()}
+
+def pausing_port(env, config):
+    port = PrioritySwitchPort(env, rate=config.output_rate, pause=True)
+    port.configure(config)
+    port.out = Discard()
+    return port
+
+def bench_port(num_priorities, packets=200000, batch=500):
+    """ Times PrioritySwitchPort.put and the transmitter (send_pkt) of a pausing
+        port, batch packets at a time so the queue crosses pause and resume
+        checkpoints but stays below qlimit.
+    """
+    config = params.SimulationConfig(num_priorities=num_priorities)
+    env = simpy.Environment()
+    port = pausing_port(env, config)
+    rng = random.Random(0)
+    put_time = 0.0
+    send_time = 0.0
+    sent = 0
+    while sent < packets:
+        batch_packets = [Packet.make(env.now, config.packet_size, sent + i, priority=rng.randrange(num_priorities))
+                         for i in range(batch)]
+        start = time.time()
+        for pkt in batch_packets:
+            port.put(pkt)
+        put_time += time.time() - start
+        start = time.time()
+        env.run()
+        send_time += time.time() - start
+        sent += batch
+    return {'num_priorities': num_priorities,
+            'packets': sent,
+            'put_per_sec': sent / put_time,
+            'send_per_sec': sent / send_time}
+
+def bench_monitor(num_priorities, samples=100000, queued=5000):
+    """ Times PortMonitor sampling of a port holding queued packets, with and without
+        a trace. A traced sample writes every priority, so there are fewer of them
+        with many priorities.
+    """
+    config = params.SimulationConfig(num_priorities=num_priorities)
+    samples = min(samples, 10**7 // num_priorities)
+    result = {'num_priorities': num_priorities, 'samples': samples}
+    fd, trace = tempfile.mkstemp(suffix='.npy')
+    os.close(fd)
+    try:
+        for name, tracing in (('stats', False), ('trace', True)):
+            env = simpy.Environment()
+            # a port too slow to send anything, so the queue stays put
+            port = PrioritySwitchPort(env, rate=1e-9)
+            port.out = Discard()
+            rng = random.Random(0)
+            for i in range(queued):
+                port.put(Packet.make(0, config.packet_size, i, priority=rng.randrange(num_priorities)))
+            pm = PortMonitor(env, port, lambda: 1e-6, trace, tracing, priorities=config.priorities)
+            start = time.time()
+            env.run(until=(samples + 0.5) * 1e-6)
+            pm.close()
+            result[name + '_per_sec'] = samples / (time.time() - start)
+    finally:
+        os.remove(trace)
+    return result
+
+def bench_hrp(num_priorities, queued=5000, calls=100000):
+    """ Times the HRP lookup of a pause on a queue holding queued packets """
+    config = params.SimulationConfig(num_priorities=num_priorities)
+    queue = PacketQueue()
+    rng = random.Random(0)
+    for i in range(queued):
+        queue.append(Packet(0, config.packet_size, i, priority=rng.randrange(num_priorities)))
+    thresholds = [rng.randrange(queued * config.packet_size) for i in range(calls)]
+    start = time.time()
+    for threshold in thresholds:
+        queue.hrp(threshold)
+    return {'num_priorities': num_priorities,
+            'queued': queued,
+            'calls_per_sec': calls / (time.time() - start)}
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(priorities=PRIORITIES, loads=LOADS, duration=0.1, batch=False, engines=ENGINES):
+    cases = [(num, k, duration, batch, engine) for num in priorities for k in loads for engine in engines]
+    # one process per case, one at a time, so each has its own peak RSS and the whole machine
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        simulations = []
+        for result in pool.imap(bench_simulate, cases):
+            print "simulate {engine} P={num_priorities} k={k}: {events_per_sec:.0f} events/s {packets_per_sec:.0f} packets/s " \
+                  "{peak_rss_mb:.0f} MB".format(**result)
+            simulations.append(result)
+    finally:
+        pool.close()
+        pool.join()
+    micro = {'port': [], 'monitor': [], 'hrp': []}
+    for num in priorities:
+        micro['port'].append(bench_port(num))
+        micro['monitor'].append(bench_monitor(num))
+        micro['hrp'].append(bench_hrp(num))
+        print "micro P={}: put {put_per_sec:.0f}/s send {send_per_sec:.0f}/s".format(num, **micro['port'][-1]),
+        print "monitor {stats_per_sec:.0f}/s traced {trace_per_sec:.0f}/s".format(**micro['monitor'][-1]),
+        print "hrp {calls_per_sec:.0f}/s".format(**micro['hrp'][-1])
+    return {'commit': commit(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': sys.version.split()[0],
+            'simpy': simpy.__version__,
+            'simulate': simulations,
+            'micro': micro}
+
+def compare(old, new):
+    """ Prints the new/old ratio of every rate that both benchmark results have """
+    def rates(results):
+        found = {}
+        for entry in results['simulate']:
+            key = 'simulate P={num_priorities} k={k}'.format(**entry)
+            if entry.get('engine', 'simpy') != 'simpy':
+                key += ' ' + entry['engine']
+            found[key + ' events/s'] = entry['events_per_sec']
+            found[key + ' packets/s'] = entry['packets_per_sec']
+        for name, entries in results['micro'].items():
+            for entry in entries:
+                for field, value in entry.items():
+                    if field.endswith('_per_sec'):
+                        found['{} P={} {}'.format(name, entry['num_priorities'], field)] = value
+        return found
+    before = rates(old)
+    after = rates(new)
+    for key in sorted(set(before) & set(after)):
+        print "{:<45} {:>12.0f} {:>12.0f} {:>6.2f}x".format(key, before[key], after[key], after[key] / before[key])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the simulator.")
+    parser.add_argument('--output', default='bench.json', help="where to write the results (default: bench.json)")
+    parser.add_argument('--duration', type=float, default=0.1, help="simulated seconds of each simulate() run")
+    parser.add_argument('--priorities', type=int, nargs='+', default=PRIORITIES)
+    parser.add_argument('--loads', type=float, nargs='+', default=LOADS)
+    parser.add_argument('--batch-arrivals', action='store_true', help="use the merged arrival stream")
+    parser.add_argument('--engines', nargs='+', default=ENGINES, choices=ENGINES,
+                        help="event loops to run simulate() in (default: both)")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help="compare two result files instead")
+    args = parser.parse_args(argv)
+    if args.compare:
+        with open(args.compare[0]) as old, open(args.compare[1]) as new:
+            compare(json.load(old), json.load(new))
+        return
+    results = run(args.priorities, args.loads, args.duration, args.batch_arrivals, args.engines)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
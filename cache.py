@@ -0,0 +1,153 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+from stats import Histogram
+
+# On-disk cache of simulation results. Every run is stored under the hash of
+# its effective configuration, its seed and the source of the simulation code,
+# so a run is only simulated again if one of those changes.
+#
+#   <directory>/<first two hex digits>/<hash>/summary.json
+#   <directory>/<first two hex digits>/<hash>/trace.npy (or trace.tr)
+#   <directory>/<first two hex digits>/<hash>/snapshot.pkl (or snapshot.npy.pkl or snapshot.tr.pkl
+#       for a run writing a trace), while the run is under way
+
+# parameters that only say where or how results are written, or which runs
+# make up a sweep, or how fast they run, and don't change what a single run computes
+# (but a steady state run stops on its percentile, see ResultCache.key(), and
+# trace_delim is kept because a cached text trace is copied back as it was written)
+IGNORED = ['percentile', 'repetitions', 'seed', 'trace', 'exp_path', 'exp_trace', 'exp_priorities', 'engine',
+           'snapshot_interval']
+
+# the modules whose code decides the result of a run
+SOURCES = ['model.py', 'kernel.py', 'generate.py', 'steady.py', 'stats.py', 'traces.py', 'workload.py']
+
+# read once, setting it back is not safe while other threads create files
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+def write_atomic(filename, write, mode='wb'):
+    """ Writes filename through a temporary file in the same directory, which
+        write(f) fills and which replaces filename once it is complete, so a
+        write that fails or is interrupted leaves nothing behind. The file
+        gets the permissions of any new file (0666 less the umask) rather than
+        the 0600 of a temporary one, so other users can read it.
+    """
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)))
+    try:
+        with os.fdopen(fd, mode) as f:
+            os.fchmod(f.fileno(), 0o666 & ~UMASK)
+            write(f)
+        os.rename(temp, filename)
+    except BaseException:
+        os.unlink(temp)
+        raise
+
+def code_version(sources=SOURCES):
+    """ Returns a hash of the simulation source files """
+    here = os.path.dirname(os.path.abspath(__file__))
+    digest = hashlib.sha1()
+    for name in sources:
+        with open(os.path.join(here, name), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+class ResultCache(object):
+    """ A content-addressed store of run summaries and traces.
+
+        Parameters
+        ----------
+        directory : string
+            where the cache lives, created if missing
+    """
+    def __init__(self, directory="cache/"):
+        self.directory = directory
+        self.version = code_version()
+
+    def key(self, config, seed):
+        """ Returns the hash of everything that decides the result of a run """
+        described = dict((name, value) for name, value in config.as_dict().items() if name not in IGNORED)
+        if config.steady_state:
+            # the run goes on until this percentile has converged
+            described['percentile'] = config.percentile
+        if config.workload is not None:
+            # a workload file rewritten under the same name is another workload
+            stat = os.stat(config.workload)
+            described['workload'] = [config.workload, stat.st_size, stat.st_mtime]
+        text = json.dumps({'config': described, 'seed': seed, 'code': self.version}, sort_keys=True)
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def snapshot_path(self, config, seed, trace=None):
+        """ Returns where the snapshots of a run under way are kept. A run
+            writing a trace (to trace, a .npy file or text) is snapshotted
+            apart from one that doesn't, since its snapshot goes on with the
+            trace it was writing.
+        """
+        entry = self.path(self.key(config, seed))
+        if not os.path.isdir(entry):
+            try:
+                os.makedirs(entry)
+            except OSError:
+                # made by another worker in the meantime
+                pass
+        if trace is None:
+            return os.path.join(entry, 'snapshot.pkl')
+        return os.path.join(entry, 'snapshot.npy.pkl' if trace.endswith('.npy') else 'snapshot.tr.pkl')
+
+    def remove_snapshots(self, config, seed):
+        """ Removes the snapshots of a run, with or without a trace """
+        entry = self.path(self.key(config, seed))
+        for name in ('snapshot.pkl', 'snapshot.npy.pkl', 'snapshot.tr.pkl'):
+            if os.path.exists(os.path.join(entry, name)):
+                os.remove(os.path.join(entry, name))
+
+    def get(self, config, seed, trace=None):
+        """ Returns the cached summary of a run, or None if it was never run.
+            If trace is given the run must have a cached trace of the same
+            format, which is copied to trace.
+        """
+        entry = self.path(self.key(config, seed))
+        try:
+            with open(os.path.join(entry, 'summary.json')) as f:
+                summary = json.load(f)
+        except IOError:
+            return None
+        if trace is not None:
+            cached = os.path.join(entry, 'trace' + os.path.splitext(trace)[1])
+            if not os.path.exists(cached):
+                return None
+            shutil.copyfile(cached, trace)
+        summary['queue_stats'] = Histogram().load_dict(summary['queue_stats'])
+        return summary
+
+    def put(self, config, seed, pm, wall_time=None, trace=None):
+        """ Stores the results of a run from its PortMonitor, and its trace file if given """
+        key = self.key(config, seed)
+        entry = self.path(key)
+        summary = {'key': key,
+                   'seed': seed,
+                   'code': self.version,
+                   'config': config.as_dict(),
+                   'packets_drop': pm.port.packets_drop,
+                   'wall_time': wall_time,
+                   'steady': pm.steady,
+                   'queue_stats': pm.queue_stats.to_dict()}
+        if not os.path.isdir(entry):
+            try:
+                os.makedirs(entry)
+            except OSError:
+                # made by another worker in the meantime
+                pass
+        if trace is not None:
+            def copy(f):
+                with open(trace, 'rb') as src:
+                    shutil.copyfileobj(src, f)
+            write_atomic(os.path.join(entry, 'trace' + os.path.splitext(trace)[1]), copy)
+        # the summary goes last, an entry counts once it has one
+        write_atomic(os.path.join(entry, 'summary.json'), lambda f: json.dump(summary, f, sort_keys=True))
+        return summary
@@ -0,0 +1,296 @@
+import math
+import time
+import argparse
+import numpy as np
+
+# Fast analytic approximation of the queue occupancy of the pausing switch.
+#
+# Switch1 forwards everything it holds as soon as it is not paused, and the
+# pausing switch never drains while it has a pause outstanding, so the two
+# queues together are work conserving: the total backlog is that of one queue
+# fed by Poisson bursts of burst_size packets and served at output_rate. Every
+# packet is one packet time of work, so the number of packets in the system is
+# the workload in packet times rounded up.
+#
+# The pausing switch holds only part of that backlog. When it reaches a pause
+# threshold, the HRP is the priority of the packets near the bottom of its
+# queue, so the bursts waiting upstream stay there unless they are of a higher
+# priority than everything already in the switch. Such a burst starts a new
+# level, which fills up to the next pause threshold. The number of levels is
+# the number of strict records among the waiting bursts in arrival order, with
+# priorities drawn uniformly. Within its top level the queue swings between
+# the resume and the pause threshold, and is taken to be anywhere in between.
+#
+# That is the steady state, while a run starts empty and lasts sim_duration.
+# Near k=1 the backlog takes about k*burst_size/(1-k)**2 packet times to
+# forget where it was (0.15 s at k=0.99), so a run sees only the part of the
+# distribution it gets to, and its max is that of far fewer independent
+# samples than one per burst. Where the queue follows the backlog, with bursts
+# no bigger than the first level, both are corrected for with a Brownian
+# approximation of the backlog (horizon_ratio() and independent_samples()),
+# and only the bursts beyond the first level can start another one, the others
+# drain before they do. With larger bursts the queue is set by the levels, the
+# corrections make it worse and the steady state is kept.
+#
+# How far off it is, against the mean of 10 packet level runs of 2 s (unless
+# said otherwise) with the default parameters and 5 or 50 priorities:
+#
+#                                                95th percentile   max
+#   burst_size=1, k=0.7 to 0.98, 0.5 to 2 s        -10 to +3%     -11 to +1%
+#   burst_size=1, k=0.99, 0.5 s                    +22 to +24%     -2 to -1%
+#   burst_size=1, k=0.99                              +20%        +16 to +17%
+#   burst_size=5 to 20, k=0.8 to 0.95, 1 or 2 s      0 to +29%    -10 to +18%
+#   burst_size=30 to 100, k=0.7 to 0.95, 1 or 2 s   -2 to +20%     -9 to +27%
+#   burst_size=50 or 100, k=0.97 or 0.99, 0.5 s    +11 to +27%     +5 to +25%
+#   burst_size=1000, k=0.9, trace_rate=1e-5 (results/exp6, 1 to 10000 priorities)
+#                                                   -7 to +4%     -12 to +11%
+#
+# estimate() flags the points outside of these: loads above MAX_LOAD, and
+# runs shorter than MIN_RELAXATIONS relaxation times where the queue follows
+# the backlog, like burst_size=5 or 20 at k=0.99 over 0.5 s (0.7 and 0.2 of
+# them), where the percentile is +28 to +61% off. All of them had the pause
+# levels of the HRP, a resume offset of B=CHECKED_B packets and the derived
+# link_delay, which the model does not look at: explicit pause_levels (the
+# per_priority and file schedules), another B and a longer link_delay are
+# flagged too. Check new ground with --check.
+#
+# python fluid.py [name=value ...] [--check] prints the estimates of every
+# point of exp_priorities, with those outside the checked points marked
+# UNCHECKED, and with --check the packet level results next to them.
+
+# the envelope the estimate was checked in
+MAX_LOAD = 0.99
+MIN_RELAXATIONS = 3.0
+CHECKED_B = 10
+
+def workload_cdf(config, packets, tail=1e-9, steps=64):
+    """ Returns P(workload <= w packet times) for w = 0, 1, ... up to packets,
+        or less if the rest of the distribution holds less than tail.
+
+        With bursts of X packet times arriving at rate lam, level crossing gives
+        F(x) = (1 - k) + lam * (integral of F over [x - X, x]), which is solved
+        forward with the trapezoid rule on at least steps points per burst.
+    """
+    if config.k >= 1:
+        raise ValueError("no steady state for load k >= 1")
+    X = config.burst_size
+    per_packet = -(-steps // X)  # grid points per packet time
+    M = X * per_packet  # grid points per burst
+    weight = float(config.k) / M  # lam * grid step
+    a = 1.0 - config.k
+    d = 1 - weight / 2
+    # the first burst by the plain recursion
+    F = [a]
+    window = a
+    for n in range(1, M):
+        value = (a + weight * (window - F[0] / 2)) / d
+        F.append(value)
+        window += value
+    blocks = [np.array(F)]
+    # every later point depends on the burst before it and the points before it in its own burst,
+    # F[i] = c[i] + beta * sum(F[:i]), so a whole burst is a geometric cumulative sum
+    beta = weight / d
+    growth = (1 + beta) ** np.arange(M)
+    while len(blocks) * M <= packets * per_packet and 1 - blocks[-1][-1] > tail:
+        prev = blocks[-1]
+        suffix = prev[::-1].cumsum()[::-1]
+        c = (a + weight * (suffix - prev / 2)) / d
+        before = np.append(0.0, (c / growth).cumsum()[:-1]) * growth / (1 + beta)
+        blocks.append(c + beta * before)
+    F = np.concatenate(blocks)[:packets * per_packet + 1:per_packet]
+    return np.minimum(F, 1.0)
+
+def packet_time(config):
+    return config.packet_size * 8.0 / config.output_rate
+
+def level_ranges(config):
+    """ Returns the resume and the pause threshold of each number of levels,
+        in packets: none for no level, one pair for every pause below qlimit
+        and qlimit for all the levels past them.
+    """
+    thresholds = config.packet_thresholds
+    resumes = [0]
+    pauses = [0]
+    for p in range(1, len(thresholds), 2):
+        if thresholds[p] < config.qlimit:
+            resumes.append(thresholds[p - 1])
+            pauses.append(thresholds[p])
+    resumes.append(config.qlimit)
+    pauses.append(config.qlimit)
+    return resumes, pauses
+
+def follows_backlog(config):
+    """ Whether the queue of the pausing switch follows the backlog up its
+        levels: a burst is no bigger than the first level, from its resume to
+        its pause threshold. Larger bursts jump whole levels at once, and the
+        queue is set by the levels rather than by the backlog.
+    """
+    resumes, pauses = level_ranges(config)
+    return config.burst_size <= pauses[1] - resumes[1]
+
+def relaxation_time(config):
+    """ Returns how long the backlog takes to forget where it was, in packet times """
+    return config.k * config.burst_size / (1.0 - config.k) ** 2
+
+def horizon_ratio(config, x, steps=200, points=200):
+    """ Returns, for backlogs x in packet times, how much less often a run of
+        sim_duration that starts empty is above x than the steady state is.
+
+        The backlog is taken as a Brownian motion reflected at 0 with drift
+        -mu = -(1 - k) and variance sigma**2 = k * burst_size per packet time.
+        Started at 0 it is above x at time t with probability
+        P(N > (x + mu t) / s) + exp(-theta x) P(N > (x - mu t) / s), where
+        s = sigma sqrt(t) and theta = 2 mu / sigma**2, against exp(-theta x)
+        in the steady state. A run samples it evenly over [0, sim_duration].
+        The ratio is smooth, so it is worked out at points values of x and
+        interpolated.
+    """
+    mu = 1.0 - config.k
+    var = config.k * config.burst_size
+    theta = 2 * mu / var
+    T = config.sim_duration / packet_time(config)
+    x = np.asarray(x, dtype=float)
+    grid = np.linspace(x.min(), x.max(), points)[:, None]
+    t = (np.arange(steps) + 0.5) * T / steps
+    s = np.sqrt(2 * var * t)
+    erfc = np.frompyfunc(math.erfc, 1, 1)
+    below = erfc((grid + mu * t) / s).astype(float) / 2
+    above = erfc((grid - mu * t) / s).astype(float) / 2
+    # the first term scaled by exp(theta x), where that doesn't overflow (and below is 0 anyway)
+    scaled = np.where(theta * grid < 700, below * np.exp(np.minimum(theta * grid, 700)), 0.0)
+    ratio = np.minimum((scaled + above).mean(axis=1), 1.0)
+    return np.interp(x, grid[:, 0], ratio)
+
+def independent_samples(config):
+    """ Returns how many independent samples of the backlog a run of
+        sim_duration holds as far as its max goes. The max of the Brownian
+        motion of horizon_ratio() over a time T is about Gumbel, with
+        P(max <= x) = exp(-mu theta T exp(-theta x)), whose mean is the
+        quantile of exp(-theta x) at 1 - 1/n for n = e**gamma mu theta T.
+    """
+    return 2 * math.exp(0.5772156649) * config.sim_duration / packet_time(config) / relaxation_time(config)
+
+def record_distribution(num_priorities, bursts, most):
+    """ Returns an array whose row n is the distribution of the number of strict
+        records in n priorities drawn uniformly from num_priorities, for n = 0 .. bursts.
+        Counts above most are added to most. Records are taken as independent.
+    """
+    P = num_priorities
+    ratios = np.arange(P, dtype=float) / P
+    power = np.ones(P)  # (v / P) ** (n - 1) for every value v
+    dist = np.zeros((bursts + 1, most + 1))
+    dist[0, 0] = 1.0
+    for n in range(1, bursts + 1):
+        # the n-th draw is a record if it is above all the ones before
+        p = power.mean()
+        dist[n] = dist[n - 1] * (1 - p)
+        dist[n, 1:] += dist[n - 1, :-1] * p
+        dist[n, -1] += dist[n - 1, -1] * p
+        power *= ratios
+    return dist
+
+def queue_distribution(config, tail=1e-9, horizon=False):
+    """ Returns (queue sizes in bytes, probabilities) for the pausing switch,
+        over a run of sim_duration that starts empty if horizon, and in the
+        steady state otherwise.
+    """
+    X = config.burst_size
+    # the range the queue moves in with each number of levels, from resume to pause threshold
+    resumes, pauses = level_ranges(config)
+    # the packet in service has already left the queue: w waiting means workload <= w + 1
+    cdf = workload_cdf(config, config.qlimit * 1000, tail)[1:]
+    if horizon:
+        cdf = 1 - (1 - cdf) * horizon_ratio(config, np.arange(1, len(cdf) + 1))
+    probs = np.diff(np.append(0.0, cdf))
+    probs[-1] += 1.0 - cdf[-1]
+    waiting = np.arange(len(probs))
+    bursts = -(-waiting // X)
+    if horizon:
+        # bursts that fit in the first level are drained before they can start another one
+        bursts = np.minimum(bursts, 1) + -(-np.maximum(waiting - resumes[1], 0) // X)
+    levels = record_distribution(len(config.priorities), bursts[-1], len(pauses) - 1)[bursts]
+    queued = np.zeros(config.qlimit + 2)
+    for d in range(len(pauses)):
+        mass = probs * levels[:, d]
+        low, high = resumes[d], pauses[d]
+        # below the level the switch holds everything that is waiting
+        under = waiting <= low
+        queued += np.bincount(waiting[under], weights=mass[under], minlength=len(queued))[:len(queued)]
+        # otherwise it is anywhere from the resume to the pause threshold, but no more than is waiting
+        over = ~under
+        width = high - low + 1.0
+        top = np.minimum(waiting[over], high + 1)
+        spread = np.zeros(len(queued) + 1)
+        spread[low] += mass[over].sum() / width
+        spread -= np.bincount(top, weights=mass[over] / width, minlength=len(spread))[:len(spread)]
+        queued += spread.cumsum()[:len(queued)]
+        held = over & (waiting <= high)
+        queued += np.bincount(waiting[held], weights=mass[held] * (high - waiting[held] + 1) / width,
+                              minlength=len(queued))[:len(queued)]
+    sizes = np.arange(len(queued)) * config.packet_size
+    return sizes[queued > 0], queued[queued > 0]
+
+def percentile(values, probs, percentile):
+    """ Returns the smallest value with at least percentile of the probability at or below it """
+    cumulative = probs.cumsum()
+    return values[min(np.searchsorted(cumulative, percentile / 100.0), len(values) - 1)]
+
+def estimate(config):
+    """ Returns the estimated percentile and max queue size in bytes of a run.
+        The max is the quantile of one sample in a run, counting samples closer
+        than the time it takes to send a burst as one, and where the queue
+        follows the backlog, no more than independent_samples(). The third
+        value is None for a point like those the estimate was checked against
+        (see above), and otherwise says how it differs from them.
+    """
+    horizon = follows_backlog(config)
+    values, probs = queue_distribution(config, horizon=horizon)
+    samples = config.sim_duration / max(config.trace_rate, config.burst_size * packet_time(config))
+    if horizon:
+        # but never so few that the max would be below the percentile
+        samples = max(min(samples, independent_samples(config)), 100.0 / (100.0 - config.percentile))
+    return (percentile(values, probs, config.percentile),
+            percentile(values, probs, 100.0 * (1 - 1.0 / samples)),
+            unchecked(config))
+
+def unchecked(config):
+    """ Returns why config is outside the points the estimate was checked
+        against, None if it is inside.
+    """
+    if config.k > MAX_LOAD:
+        return "load above {:g}".format(MAX_LOAD)
+    if config.pause_levels is not None:
+        return "explicit pause_levels, the model pauses at the HRP"
+    if config.B != CHECKED_B:
+        return "resume offset B={}, checked with {}".format(config.B, CHECKED_B)
+    # as long as it takes B packets to come in at input_rate, as derived
+    if config.link_delay * config.input_rate > config.B * config.packet_size * 8 * (1 + 1e-9):
+        return "link_delay of {:g} s, longer than B packets at input_rate".format(config.link_delay)
+    runs = config.sim_duration / packet_time(config) / relaxation_time(config)
+    if follows_backlog(config) and runs < MIN_RELAXATIONS:
+        return "run of {:.1f} relaxation times, fewer than {:g}".format(runs, MIN_RELAXATIONS)
+    return None
+
+def main(argv=None):
+    from generate import parse_config_args, sweep_point
+    parser = argparse.ArgumentParser(description="Estimate pausing switch queue sizes analytically.",
+                                     epilog="Any name=value argument, among the options or after them, overrides "
+                                            "a parameter from params.py, e.g. k=0.95.")
+    parser.add_argument('--check', action='store_true',
+                        help="also run the packet level simulations of every point and print their mean")
+    args, config = parse_config_args(parser, argv)
+    for num in config.exp_priorities:
+        start = time.time()
+        fluid_p, fluid_max, outside = estimate(config.replace(num_priorities=num))
+        line = "{}\tfluid {:.0f} {:.0f} ({:.1f} ms)".format(num, fluid_p, fluid_max, 1000 * (time.time() - start))
+        if outside is not None:
+            line += "\tUNCHECKED: " + outside
+        if args.check:
+            runs = [sweep_point((config, num, rep, None)) for rep in range(config.repetitions)]
+            packet_p, packet_max = np.mean([r[2] for r in runs]), np.mean([r[3] for r in runs])
+            line += "\tpacket {:.0f} {:.0f} (fluid {:+.0f}% {:+.0f}%)".format(
+                packet_p, packet_max, 100 * (fluid_p / packet_p - 1), 100 * (fluid_max / packet_max - 1))
+        print line
+
+if __name__ == '__main__':
+    main()
@@ -1,93 +1,101 @@
 import simpy
 import params
+import os
+import ast
+import time
+import random
+import argparse
+import multiprocessing
 import numpy as np
-from random import expovariate, seed
-from model import PacketGenerator, PacketSink, PrioritySwitchPort, Checkpoint, CheckpointAction, PortMonitor
-
-# def simulate(priorities, trace, burst_interval):
-#     with open(trace, 'a') as tr:
-#         tr.write(str(len(priorities)))
-#         for i in range(params.repetitions):
-#             print i
-#             ## Setup experiment   ----------------------
-#             env = simpy.Environment()  # Create the SimPy environment
-#             # Create the packet generators and sink
-#             ps = PacketSink(env, debug=False)  # debugging enable for simple output
-#             pgs = []
-#             for priority in priorities:
-#                 pgs.append(PacketGenerator(env, priority, params.burst_size, lambda: expovariate(1.0/burst_interval), lambda: params.packet_size, flow_id=priority, priority=priority))
-
-#             switch1 = PrioritySwitchPort(env, rate=params.input_rate, qlimit=None, pause=False, debug=False)
-#             switch2 = PrioritySwitchPort(env, rate=params.output_rate, qlimit=params.qlimit * params.packet_size, pause=True, debug=False)
-
-#             checkpoints = []
-#             checkpoints.append(Checkpoint(-1, CheckpointAction.NONE))
-#             checkpoints.append(Checkpoint(params.qlimit, CheckpointAction.NONE))
-#             for r in range(0, len(params.packet_thresholds), 2):
-#                 # start with the resumes
-#                 checkpoints.append(Checkpoint(params.packet_thresholds[r] * params.packet_size, CheckpointAction.RESUME))
-#             for p in range(1, len(params.packet_thresholds), 2):
-#                 # then the pauses
-#                 checkpoints.append(Checkpoint(params.packet_thresholds[p] * params.packet_size, CheckpointAction.PAUSE))
-
-#             checkpoints.sort()
-#             switch2.checkpoints = checkpoints
-#             switch2.link_delay = params.link_delay
-#             switch2.back = switch1
-
-#             # pm1 = PortMonitor(env, switch1, lambda: trace_rate, tr1_file)
-#             pm2 = PortMonitor(env, switch2, lambda: params.trace_rate, trace, True)
-
-#             # Wire packet generators and sink together
-#             for pg in pgs:
-#                 pg.out = switch1
-#             switch1.out = switch2
-#             switch2.out = ps
-
-
-#             ## Simulate  ----------------------------------
-#             seed(params.seed[i])
-#             while env.peek() < params.sim_duration:
-#                 env.step()
-#             tr.write(params.trace_delim)
-#             tr.write(str(np.percentile(pm2.queue_sizes, params.percentile)))
-#             tr.write(params.trace_delim)
-#             tr.write(str(np.percentile(pm2.queue_sizes, 100)))
-#         tr.write('\n')
-
-# for num in params.exp_priorities:
-#     burst_interval = (num * params.burst_size * params.packet_size) / (params.k * params.output_rate / 8)
-#     simulate(range(num), params.exp_path + params.exp_trace, burst_interval)
-
-def simulate(priorities, trace, burst_interval):
+from functools import partial
+from model import (PacketGenerator, MergedPacketGenerator, WorkloadPacketGenerator, PacketSink, PrioritySwitchPort,
+                   PortMonitor, PauseLog)
+from kernel import (Kernel, KernelPacketGenerator, KernelMergedPacketGenerator, KernelWorkloadPacketGenerator,
+                    KernelSwitchPort, KernelPacketSink, KernelPortMonitor)
+from cache import ResultCache
+import instrument
+import snapshot
+import steady
+import metrics
+
+class Constant(object):
+    """ A function that always returns value, or a list of n of them if given n.
+        Unlike a lambda it can be pickled into a snapshot.
+    """
+    def __init__(self, value):
+        self.value = value
+
+    def __call__(self, n=None):
+        if n is None:
+            return self.value
+        return [self.value] * n
+
+def simulate(config=None, seed=0, trace=None, env=None, pause_log=None, snapshot_file=None):
+    """ Runs one simulation of config (a params.SimulationConfig, the defaults
+        in params.py if None) and returns the monitor of the pausing switch.
+        Each run draws from its own random.Random(seed), or numpy RandomState(seed)
+        with batch_arrivals, so runs in the same process or in different
+        processes don't share random state.
+        With config.workload the packets are those of the workload file
+        instead (see workload.py), the same whatever the seed.
+        If trace is None no trace is written, the monitor only records queue_stats.
+        The run takes place in env if given, which must be a fresh simpy.Environment
+        or kernel.Kernel, and otherwise in a new one of the kind config.engine names.
+        If pause_log (a model.PauseLog) is given, the pauses of both switches are recorded to it.
+        With config.steady_state the run goes on until the percentile queue size
+        has converged (see steady.py), the queue_stats of the monitor leave out
+        the warm-up and its steady member holds what steady.run() found;
+        otherwise steady is None.
+        If snapshot_file is given, a snapshot of the run is saved there every
+        config.snapshot_interval simulated seconds, to go on from with resume().
+    """
+    if config is None:
+        config = params.SimulationConfig()
+    rng = random.Random(seed)
+    burst_interval = config.burst_interval
     ## Setup experiment   ----------------------
-    env = simpy.Environment()  # Create the SimPy environment
+    if env is None:
+        env = Kernel() if config.engine == "kernel" else simpy.Environment()  # Create the environment
+    if isinstance(env, Kernel):
+        Generator, MergedGenerator, WorkloadGenerator, SwitchPort, Sink, Monitor = (
+            KernelPacketGenerator, KernelMergedPacketGenerator, KernelWorkloadPacketGenerator, KernelSwitchPort,
+            KernelPacketSink, KernelPortMonitor)
+    else:
+        if snapshot_file is not None:
+            raise ValueError("only a run in a kernel.Kernel can be snapshotted")
+        Generator, MergedGenerator, WorkloadGenerator, SwitchPort, Sink, Monitor = (
+            PacketGenerator, MergedPacketGenerator, WorkloadPacketGenerator, PrioritySwitchPort, PacketSink,
+            PortMonitor)
+    if snapshot_file is not None and not config.snapshot_interval:
+        raise ValueError("snapshots need a snapshot_interval")
     # Create the packet generators and sink
-    ps = PacketSink(env, debug=False)  # debugging enable for simple output
+    ps = Sink(env, debug=False)  # debugging enable for simple output
     pgs = []
-    for priority in priorities:
-        pgs.append(PacketGenerator(env, priority, params.burst_size, lambda: expovariate(1.0/burst_interval), lambda: params.packet_size, flow_id=priority, priority=priority))
-
-    switch1 = PrioritySwitchPort(env, rate=params.input_rate, qlimit=None, pause=False, debug=False)
-    switch2 = PrioritySwitchPort(env, rate=params.output_rate, qlimit=params.qlimit * params.packet_size, pause=True, debug=False)
-
-    checkpoints = []
-    checkpoints.append(Checkpoint(-1, CheckpointAction.NONE))
-    checkpoints.append(Checkpoint(params.qlimit, CheckpointAction.NONE))
-    for r in range(0, len(params.packet_thresholds), 2):
-        # start with the resumes
-        checkpoints.append(Checkpoint(params.packet_thresholds[r] * params.packet_size, CheckpointAction.RESUME))
-    for p in range(1, len(params.packet_thresholds), 2):
-        # then the pauses
-        checkpoints.append(Checkpoint(params.packet_thresholds[p] * params.packet_size, CheckpointAction.PAUSE))
-
-    checkpoints.sort()
-    switch2.checkpoints = checkpoints
-    switch2.link_delay = params.link_delay
-    switch2.back = switch1
+    if config.workload is not None:
+        pgs.append(WorkloadGenerator(env, 'workload', config.workload, config.num_priorities))
+    elif config.batch_arrivals:
+        pgs.append(MergedGenerator(env, config.priorities, config.priorities, config.burst_size, burst_interval,
+                                   Constant(config.packet_size), np.random.RandomState(seed)))
+    else:
+        for priority in config.priorities:
+            pgs.append(Generator(env, priority, config.burst_size, partial(rng.expovariate, 1.0/burst_interval), Constant(config.packet_size), flow_id=priority, priority=priority))
+
+    switch1 = SwitchPort(env, rate=config.input_rate, qlimit=None, pause=False, debug=False)
+    switch2 = SwitchPort(env, rate=config.output_rate, pause=True, debug=False)
+    switch2.configure(config)
+    switch2.back = [switch1]
+    if pause_log is not None:
+        pause_log.name(switch1, 'switch1')
+        pause_log.name(switch2, 'switch2')
+        switch1.pause_log = pause_log
+        switch2.pause_log = pause_log
+    if isinstance(env, instrument.InstrumentedEnvironment):
+        env.name(switch1, 'switch1')
+        env.name(switch2, 'switch2')
 
     # pm1 = PortMonitor(env, switch1, lambda: trace_rate, tr1_file)
-    pm2 = PortMonitor(env, switch2, lambda: params.trace_rate, trace, True)
+    pm2 = Monitor(env, switch2, Constant(config.trace_rate), trace, trace is not None,
+                  priorities=config.priorities, delim=config.trace_delim, keep_samples=config.steady_state)
 
     # Wire packet generators and sink together
     for pg in pgs:
@@ -95,11 +103,286 @@ def simulate(priorities, trace, burst_interval):
     switch1.out = switch2
     switch2.out = ps
 
+    state = {'config': config,
+             'seed': seed,
+             'env': env,
+             'generators': pgs,
+             'ports': [switch1, switch2],
+             'sink': ps,
+             'monitor': pm2,
+             'pause_log': pause_log,
+             'until': None,  # where the run is headed
+             'next_snapshot': config.snapshot_interval}
+    return finish(state, snapshot_file)
+
+def finish(state, snapshot_file=None):
+    """ Runs the simulation of state, set up by simulate() or restored by
+        resume(), to its end and returns its monitor
+    """
+    config = state['config']
+    env = state['env']
+    pm2 = state['monitor']
 
     ## Simulate  ----------------------------------
-    seed(0)
-    while env.peek() < params.sim_duration:
-        env.step()
+    def advance(until):
+        state['until'] = until
+        if isinstance(env, Kernel):
+            if snapshot_file is not None and state['next_snapshot'] is not None:
+                while state['next_snapshot'] < until:
+                    env.run(state['next_snapshot'])
+                    state['next_snapshot'] += config.snapshot_interval
+                    snapshot.save(snapshot_file, state)
+            env.run(until)
+        else:
+            while env.peek() < until:
+                env.step()
+
+    metrics.watch(env, pm2, {'num_priorities': config.num_priorities, 'k': config.k, 'seed': state['seed']})
+    try:
+        if config.steady_state:
+            pm2.steady = steady.run(advance, pm2, config, state['until'])
+        else:
+            advance(config.sim_duration)
+            pm2.steady = None
+    finally:
+        metrics.unwatch()
+    pm2.close()
+    if state['pause_log'] is not None:
+        state['pause_log'].finish(env.now)
+    return pm2
+
+# what can't change when a run goes on from a snapshot with another config
+FIXED = ['packet_size', 'priorities', 'burst_size', 'batch_arrivals', 'workload', 'engine', 'k', 'output_rate',
+         'input_rate', 'burst_interval', 'trace_rate', 'trace_delim']
+
+def resume(filename, config=None, trace=None, snapshot_file=None):
+    """ Goes on with a run from a snapshot saved by simulate() and returns its
+        monitor, the same as simulate() would have returned.
+
+        If config is given the rest of the run follows it instead, which forks
+        the run: it may differ from the config of the run in anything but the
+        FIXED parameters, e.g. in sim_duration or the pause thresholds.
+        If the run has a trace it goes on in trace if given, which gets a copy
+        of the trace up to the snapshot, and otherwise in the file it was
+        being written to, cutting off whatever was written after the snapshot.
+        Snapshots go on being saved to snapshot_file if given.
+    """
+    state = snapshot.load(filename)
+    if config is not None:
+        fork(state, config)
+    pm2 = state['monitor']
+    if pm2.tr is not None:
+        pm2.tr.reopen(trace)
+    return finish(state, snapshot_file)
+
+def fork(state, config):
+    """ Switches the restored run of state over to config """
+    old = state['config']
+    changed = [name for name in FIXED if getattr(config, name) != getattr(old, name)]
+    if changed:
+        raise ValueError("can't change {} in the middle of a run".format(", ".join(changed)))
+    state['ports'][1].configure(config)
+    state['monitor'].keep_samples = config.steady_state
+    if config.snapshot_interval != old.snapshot_interval:
+        state['next_snapshot'] = state['env'].now + config.snapshot_interval if config.snapshot_interval else None
+    state['config'] = config
+
+def run(config=None, seed=0, trace=None, cache=None):
+    """ Like simulate(), but looks the run up in cache (a cache.ResultCache) first
+        and stores it there if it had to be simulated. Returns the cache summary
+        of the run: a dict with its queue_stats, packets_drop and config.
+        With config.snapshot_interval the run is snapshotted into the cache as
+        it goes, and a run that was stopped goes on from its last snapshot.
+    """
+    if config is None:
+        config = params.SimulationConfig()
+    summary = cache.get(config, seed, trace) if cache is not None else None
+    if summary is None:
+        start = time.time()
+        snapshot_file = None
+        if cache is not None and config.snapshot_interval and config.engine == "kernel":
+            snapshot_file = cache.snapshot_path(config, seed, trace)
+        if snapshot_file is not None and os.path.exists(snapshot_file):
+            # a run of this that was stopped before it finished
+            pm2 = resume(snapshot_file, trace=trace, snapshot_file=snapshot_file)
+        else:
+            pm2 = simulate(config, seed, trace, snapshot_file=snapshot_file)
+        wall_time = time.time() - start
+        if cache is not None:
+            summary = cache.put(config, seed, pm2, wall_time, trace)
+            if snapshot_file is not None:
+                # including those of the run with another trace, which is cached now
+                cache.remove_snapshots(config, seed)
+        else:
+            summary = {'config': config.as_dict(), 'seed': seed, 'packets_drop': pm2.port.packets_drop,
+                       'wall_time': wall_time, 'steady': pm2.steady}
+        summary['queue_stats'] = pm2.queue_stats
+    return summary
+
+def sweep_point(point):
+    """ Simulates one (config, number of priorities, repetition, cache) point of a sweep,
+        unless it is in the cache (which may be None), and returns
+        (number of priorities, repetition, percentile queue size, max queue size).
+    """
+    config, num, rep, cache = point
+    config = config.replace(num_priorities=num)
+    queue_stats = run(config, config.seed[rep], cache=cache)['queue_stats']
+    return (num, rep,
+            queue_stats.percentile(config.percentile),
+            queue_stats.percentile(100))
+
+def sweep(config=None, processes=None, cache=None, metrics_options=None):
+    """ Runs every (number of priorities, repetition) point of config.exp_priorities
+        and config.repetitions in a process pool. Results come back in grid
+        order no matter which worker ran them.
+        With a cache only the points missing from it are simulated, and each
+        one is stored as soon as it finishes, so an interrupted or extended
+        sweep picks up where it left off.
+        With metrics_options, the (port, filename, interval) of metrics.start(),
+        every worker exports the metrics of its runs.
+    """
+    if config is None:
+        config = params.SimulationConfig()
+    grid = [(config, num, rep, cache) for num in config.exp_priorities for rep in range(config.repetitions)]
+    table = [None] * len(grid)
+    if cache is not None:
+        for i, (_, num, rep, _) in enumerate(grid):
+            point = config.replace(num_priorities=num)
+            summary = cache.get(point, point.seed[rep])
+            if summary is not None:
+                table[i] = (num, rep,
+                            summary['queue_stats'].percentile(point.percentile),
+                            summary['queue_stats'].percentile(100))
+    missing = [i for i in range(len(grid)) if table[i] is None]
+    if missing:
+        # hand out the most expensive points first so they don't finish last
+        order = sorted(missing, key=lambda i: -grid[i][1])
+        if metrics_options is not None:
+            pool = multiprocessing.Pool(processes, metrics.start, metrics_options + (multiprocessing.Value('i', 0),))
+        else:
+            pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(sweep_point, [grid[i] for i in order], chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        for i, result in zip(order, results):
+            table[i] = result
+    return table
+
+def write_params(config, filename):
+    """ Writes every parameter of config, one name = value line each, to record what a sweep ran """
+    with open(filename, 'w') as f:
+        for name, value in sorted(config.as_dict().items()):
+            f.write("{} = {!r}\n".format(name, value))
+
+def write_sweep(table, trace, delim=params.trace_delim):
+    """ Writes one line per number of priorities: the count followed by the
+        percentile and max queue size of each repetition.
+    """
+    with open(trace, 'w') as tr:
+        num = None
+        for row in table:
+            if row[0] != num:
+                if num is not None:
+                    tr.write('\n')
+                num = row[0]
+                tr.write(str(num))
+            tr.write(delim)
+            tr.write(repr(float(row[2])))
+            tr.write(delim)
+            tr.write(repr(float(row[3])))
+        tr.write('\n')
+
+def parse_override(text):
+    """ Parses a name=value argument, reading value as a Python literal if it is one """
+    name, sep, value = text.partition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError("expected name=value, got {}".format(text))
+    try:
+        value = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        pass
+    return name, value
+
+def parse_config_args(parser, argv=None):
+    """ Parses the command line argv with parser, taking every name=value
+        argument left over, wherever it is, as an override of a parameter from
+        params.py. Returns the parsed options and the SimulationConfig.
+    """
+    args, rest = parser.parse_known_args(argv)
+    try:
+        config = params.SimulationConfig(**dict(parse_override(text) for text in rest))
+    except (argparse.ArgumentTypeError, TypeError) as e:
+        parser.error(str(e))
+    return args, config
 
-simulate(params.priorities, params.trace, params.burst_interval)
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate a lossless pFabric switch port.",
+                                     epilog="Any name=value argument, among the options or after them, overrides "
+                                            "a parameter from params.py, e.g. k=0.95 num_priorities=10.")
+    parser.add_argument('--sweep', action='store_true',
+                        help="run the exp_priorities x repetitions sweep and write exp_path + exp_trace")
+    parser.add_argument('--processes', type=int, default=None,
+                        help="worker processes for a sweep (default: one per core)")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="seed of a single run")
+    parser.add_argument('--cache', default="cache/",
+                        help="directory of the result cache (default: cache/)")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="simulate every run, without reading or writing the cache")
+    parser.add_argument('--instrument', action='store_true',
+                        help="count events, wall time and queue depths per kind of process of a single run "
+                             "and write them next to the trace (.instrument.json)")
+    parser.add_argument('--profile', action='store_true',
+                        help="run a single run under cProfile and write the stats next to the trace (.prof)")
+    parser.add_argument('--pause-log', metavar='FILE.npy', default=None,
+                        help="record every pause and resume of a single run to FILE.npy, "
+                             "and the paused time and pauses per priority to FILE.json")
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help="serve live metrics of the runs on this local port (the workers of a sweep "
+                             "on the ports after it)")
+    parser.add_argument('--metrics-file', default=None,
+                        help="write live metrics of the runs to this file (one per worker of a sweep)")
+    parser.add_argument('--metrics-interval', type=float, default=1.0,
+                        help="seconds between updates of the metrics (default: 1)")
+    args, config = parse_config_args(parser, argv)
+    cache = None if args.no_cache else ResultCache(args.cache)
+    metrics_options = None
+    if args.metrics_port is not None or args.metrics_file is not None:
+        metrics_options = (args.metrics_port, args.metrics_file, args.metrics_interval)
+        if not args.sweep:
+            metrics.start(*metrics_options)
+    if args.sweep:
+        # before the sweep, so a path that can't be written to fails before anything is simulated
+        if config.exp_path and not os.path.isdir(config.exp_path):
+            os.makedirs(config.exp_path)
+        table = sweep(config, args.processes, cache, metrics_options)
+        write_sweep(table, config.exp_path + config.exp_trace, config.trace_delim)
+        write_params(config, config.exp_path + "params.txt")
+    elif args.instrument or args.profile or args.pause_log:
+        # always simulated, a cached result has nothing to measure
+        base = os.path.splitext(config.trace)[0]
+        env = instrument.InstrumentedEnvironment() if args.instrument else None
+        pause_log = PauseLog() if args.pause_log else None
+        if args.profile:
+            instrument.profile(simulate, base + '.prof', config, args.seed, config.trace, env, pause_log)
+        else:
+            simulate(config, args.seed, config.trace, env, pause_log)
+        if args.instrument:
+            report = env.report()
+            instrument.print_report(report)
+            instrument.write_report(report, base + '.instrument.json')
+        if pause_log is not None:
+            pause_log.save(args.pause_log, len(config.priorities))
+    else:
+        summary = run(config, args.seed, config.trace, cache)
+        found = summary.get('steady')
+        if found is not None:
+            print "warm-up {:g} s, ran {:g} s: {:g}th percentile {} +- {} bytes{}".format(
+                found['warmup_time'], found['duration'], config.percentile, found['estimate'],
+                found['half_width'], '' if found['converged'] else ' (not converged)')
+    metrics.stop()
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+import json
+import time
+import pstats
+import cProfile
+import simpy
+from simpy.core import BoundClass
+from stats import Histogram
+
+# Opt-in instrumentation of a simulation. Running it in an InstrumentedEnvironment
+# instead of a simpy.Environment wraps the body of every SimPy process, so each
+# time a process is resumed its component (owner class and method, e.g.
+# PrioritySwitchPort.send_pause) gets an event counted, the wall time spent in
+# the body added, and the depth of the queue it works on recorded. Components
+# working on different ports are kept apart, e.g. PrioritySwitchPort.run[switch1]
+# and PrioritySwitchPort.run[switch2], the ports being numbered in the order
+# their first process starts unless given a name(). A run in a plain
+# simpy.Environment is not touched at all.
+
+class ComponentStats(object):
+    """ What was recorded for one kind of process on one port """
+    def __init__(self, name, port=None):
+        self.name = name
+        self.port = port
+        self.events = 0
+        self.wall_time = 0.0
+        self.depths = Histogram()
+
+    def summary(self):
+        summary = {'events': self.events,
+                   'wall_time': self.wall_time,
+                   'us_per_event': 1e6 * self.wall_time / self.events if self.events else 0.0}
+        if self.depths.count:
+            summary['queue_bytes'] = {'mean': self.depths.mean(),
+                                      'p50': self.depths.percentile(50),
+                                      'p99': self.depths.percentile(99),
+                                      'max': self.depths.max}
+        return summary
+
+def watched_port(owner):
+    """ Returns the port whose queue a process owner works on, or None """
+    if hasattr(owner, 'byte_size'):
+        return owner
+    for name in ('port', 'out'):
+        port = getattr(owner, name, None)
+        if hasattr(port, 'byte_size'):
+            return port
+    return None
+
+class InstrumentedProcess(object):
+    """ Stands in for the generator of a SimPy process and records every resume of it """
+    def __init__(self, generator, stats, port):
+        self.generator = generator
+        self.stats = stats
+        self.port = port
+        self.__name__ = generator.__name__
+        self.gi_frame = generator.gi_frame
+
+    def send(self, value):
+        stats = self.stats
+        stats.events += 1
+        if self.port is not None:
+            stats.depths.add(self.port.byte_size)
+        start = time.time()
+        try:
+            return self.generator.send(value)
+        finally:
+            stats.wall_time += time.time() - start
+
+    def throw(self, *args):
+        stats = self.stats
+        stats.events += 1
+        start = time.time()
+        try:
+            return self.generator.throw(*args)
+        finally:
+            stats.wall_time += time.time() - start
+
+    def next(self):
+        return self.send(None)
+
+    def close(self):
+        self.generator.close()
+
+class InstrumentedEnvironment(simpy.Environment):
+    """ A simpy.Environment whose processes are instrumented. components maps
+        each (component name, port or None) to its ComponentStats, and ports
+        each port to its name.
+    """
+    def __init__(self, *args, **kwargs):
+        simpy.Environment.__init__(self, *args, **kwargs)
+        # bind_early only binds what our own class defines, do the rest except process()
+        for name, obj in simpy.Environment.__dict__.items():
+            if type(obj) is BoundClass and name != 'process':
+                setattr(self, name, getattr(self, name))
+        self.components = {}
+        self.ports = {}
+        self.steps = 0
+        self.wall_time = 0.0
+        self.started = time.time()
+
+    def process(self, generator):
+        owner = generator.gi_frame.f_locals.get('self')
+        name = generator.__name__
+        if owner is not None:
+            name = type(owner).__name__ + '.' + name
+        port = watched_port(owner)
+        if port is not None and port not in self.ports:
+            self.ports[port] = str(len(self.ports))
+        if (name, port) not in self.components:
+            self.components[name, port] = ComponentStats(name, port)
+        return simpy.events.Process(self, InstrumentedProcess(generator, self.components[name, port], port))
+
+    def name(self, port, name):
+        """ Names a port in the report """
+        self.ports[port] = name
+
+    def component_name(self, stats):
+        if stats.port is None:
+            return stats.name
+        return '{}[{}]'.format(stats.name, self.ports[stats.port])
+
+    def step(self):
+        self.steps += 1
+        simpy.Environment.step(self)
+
+    def report(self):
+        """ Returns what was recorded as a dict. The time not spent in any process
+            body is SimPy's own scheduling, reported as kernel_time.
+        """
+        wall_time = time.time() - self.started
+        components = dict((self.component_name(stats), stats.summary()) for stats in self.components.values())
+        return {'events': self.steps,
+                'wall_time': wall_time,
+                'kernel_time': wall_time - sum(stats.wall_time for stats in self.components.values()),
+                'components': components}
+
+def write_report(report, filename):
+    with open(filename, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+def print_report(report):
+    print "{} events in {:.2f} s, {:.2f} s of it in SimPy itself".format(
+        report['events'], report['wall_time'], report['kernel_time'])
+    rows = sorted(report['components'].items(), key=lambda item: -item[1]['wall_time'])
+    for name, summary in rows:
+        line = "{:<40} {:>10} events {:>8.3f} s {:>7.2f} us/event".format(
+            name, summary['events'], summary['wall_time'], summary['us_per_event'])
+        if 'queue_bytes' in summary:
+            line += "  queue mean {mean:.0f} p99 {p99:.0f} max {max} bytes".format(**summary['queue_bytes'])
+        print line
+
+def profile(function, filename, *args, **kwargs):
+    """ Calls function under cProfile, writes the stats to filename (for pstats or
+        snakeviz) and prints the top of them. Returns what function returned.
+    """
+    profiler = cProfile.Profile()
+    result = profiler.runcall(function, *args, **kwargs)
+    profiler.dump_stats(filename)
+    pstats.Stats(filename).sort_stats('cumulative').print_stats(20)
+    return result
@@ -0,0 +1,258 @@
+import heapq
+from functools import partial
+from model import (PacketGenerator, MergedPacketGenerator, WorkloadPacketGenerator, PacketSink, PrioritySwitchPort,
+                   PortMonitor)
+
+# A discrete event kernel for the standard topology (generators -> switch1 ->
+# pausing switch2 -> sink) that stands in for a simpy.Environment, so that a
+# run can be snapshotted and resumed. A SimPy run lives in its generator
+# processes and Event objects, which can't be pickled; here every event is a
+# (time, priority, id, callback) entry in one heap, and the transmitters of
+# the ports are state machines called straight from it.
+#
+# Events are ordered exactly like SimPy orders them (by time, then URGENT
+# before NORMAL, then by creation), so a run gives the same results as under
+# SimPy for the same seed. The events SimPy has that this kernel leaves out
+# (Store puts and gets, process exits) have no effect: at most the transmitter
+# takes its zero length turn after them instead of before.
+#
+# With many priorities nearly every pending event is the next burst of one of
+# the generators, so the few events of the transmitters are kept in a heap of
+# their own and the loop takes whichever of the two comes first.
+#
+# It runs the same model code per packet as under SimPy (the generators, both
+# ports and their PacketQueues, the checkpoints and the sink), and is not the
+# way to make runs fast. SimPy stays the default and the kernel is used with
+# engine = "kernel", which snapshots need; the two must order events alike for
+# as long as both are kept.
+#
+# The components are the Kernel versions of the model classes below, which
+# keep no state in generators, so a whole run can be pickled (see snapshot.py).
+# Other processes that only yield timeouts can still be started with process().
+
+URGENT = 0
+NORMAL = 1
+
+class Kernel(object):
+    """ The event loop. Like a simpy.Environment it has now, timeout(),
+        process(), peek(), step() and run(until), where timeout(delay)
+        returns the delay itself and a process is a generator that yields
+        nothing but timeouts.
+
+        Members
+        -------
+        steps : int
+            number of events processed so far
+    """
+    def __init__(self, initial_time=0.0):
+        self.now = initial_time
+        self.heap = []  # the events of the processes
+        self.ports = []  # the events of the transmitters
+        self.eid = 0
+        self.steps = 0
+
+    def schedule(self, callback, delay=0, priority=NORMAL):
+        self.eid += 1
+        heapq.heappush(self.heap, (self.now + delay, priority, self.eid, callback))
+
+    def schedule_port(self, callback, delay=0):
+        """ Like schedule(), for the transmitter of a port """
+        self.eid += 1
+        heapq.heappush(self.ports, (self.now + delay, NORMAL, self.eid, callback))
+
+    def timeout(self, delay):
+        if delay < 0:
+            raise ValueError("negative delay {}".format(delay))
+        return delay
+
+    def process(self, generator):
+        """ Starts a process at the current time. Components the kernel drives
+            itself have no process and pass None.
+        """
+        if generator is None:
+            return None
+        def resume():
+            try:
+                delay = next(generator)
+            except StopIteration:
+                return
+            self.schedule(resume, delay)
+        self.schedule(resume, 0, URGENT)
+        return generator
+
+    def next_queue(self):
+        """ Returns the heap holding the next event, None if there is none """
+        if self.ports and (not self.heap or self.ports[0] < self.heap[0]):
+            return self.ports
+        return self.heap or None
+
+    def peek(self):
+        """ Returns the time of the next event, infinity if there is none """
+        queue = self.next_queue()
+        return queue[0][0] if queue else float("inf")
+
+    def step(self):
+        self.now, priority, eid, callback = heapq.heappop(self.next_queue())
+        self.steps += 1
+        callback()
+
+    def run(self, until=float("inf")):
+        """ Processes every event before until """
+        heap = self.heap
+        ports = self.ports
+        pop = heapq.heappop
+        while True:
+            if ports and (not heap or ports[0] < heap[0]):
+                queue = ports
+            elif heap:
+                queue = heap
+            else:
+                break
+            if queue[0][0] >= until:
+                break
+            self.now, priority, eid, callback = pop(queue)
+            callback()
+            # kept up to date, metrics.py reads it while the run goes on
+            self.steps += 1
+
+class KernelPacketGenerator(PacketGenerator):
+    """ A PacketGenerator run by a Kernel """
+    def run(self):
+        self.env.schedule(self.start, 0, URGENT)
+
+    def start(self):
+        self.env.schedule(self.schedule_next, self.env.timeout(self.initial_delay))
+
+    def schedule_next(self):
+        if self.env.now < self.finish:
+            self.env.schedule(self.fire, self.env.timeout(self.burst_dist()))
+
+    def fire(self):
+        self.burst()
+        self.schedule_next()
+
+class KernelMergedPacketGenerator(MergedPacketGenerator):
+    """ A MergedPacketGenerator run by a Kernel. index is the next burst of the current block. """
+    def run(self):
+        self.index = self.block_size
+        self.env.schedule(self.start, 0, URGENT)
+
+    def start(self):
+        self.env.schedule(self.schedule_next, self.env.timeout(self.initial_delay))
+
+    def schedule_next(self):
+        if self.index == self.block_size:
+            self.draw_block()
+            self.index = 0
+        if self.env.now < self.finish:
+            self.env.schedule(self.fire, self.env.timeout(self.gaps[self.index]))
+
+    def fire(self):
+        self.burst(self.index)
+        self.index += 1
+        self.schedule_next()
+
+class KernelWorkloadPacketGenerator(WorkloadPacketGenerator):
+    """ A WorkloadPacketGenerator run by a Kernel. index is the next packet of the current block. """
+    def run(self):
+        self.index = 0
+        self.times = []
+        self.env.schedule(self.schedule_next, 0, URGENT)
+
+    def schedule_next(self):
+        if self.index == len(self.times):
+            if not self.read_block():
+                return
+            self.index = 0
+        if self.env.now < self.finish:
+            self.env.schedule(self.fire, self.env.timeout(self.delay(self.index)))
+
+    def fire(self):
+        self.send(self.index)
+        self.index += 1
+        self.schedule_next()
+
+class KernelPortMonitor(PortMonitor):
+    """ A PortMonitor run by a Kernel """
+    def run(self):
+        self.env.schedule(self.schedule_next, 0, URGENT)
+
+    def schedule_next(self):
+        self.env.schedule(self.fire, self.env.timeout(self.dist()))
+
+    def fire(self):
+        self.sample()
+        self.schedule_next()
+
+class KernelSwitchPort(PrioritySwitchPort):
+    """ A PrioritySwitchPort run by a Kernel. Queueing, drops, checkpoints and
+        pauses are those of PrioritySwitchPort; the transmitter (run() there)
+        is the state machine of transmit() and finished(), and waiting is True
+        rather than an event while it sleeps. A pause or resume is started like
+        the send_pause() and send_resume() processes, and delivered upstream
+        link_delay later.
+    """
+    def run(self):
+        # the transmitter starts out with nothing to send
+        self.wait(False)
+
+    def wait(self, unpause):
+        self.waiting = True
+        self.waiting_unpause = unpause
+
+    def wake(self):
+        self.waiting = None
+        self.env.schedule_port(self.finished if self.waiting_unpause else self.transmit)
+
+    def finished(self):
+        """ The end of a transmission or of a wait for a resume: the top of the loop of run() """
+        self.busy = 0
+        env = self.env
+        if not self.queue:
+            # sleep until put() hands us a packet
+            self.wait(False)
+        elif (env.heap and env.heap[0][0] <= env.now) or (env.ports and env.ports[0][0] <= env.now):
+            # let everything else happening at this instant go first
+            self.env.schedule_port(self.transmit)
+        else:
+            self.transmit()
+
+    def transmit(self):
+        self.busy = 1
+        pkt = self.queue.peek()
+        if self.pause_rec and pkt.priority <= self.pause_level:
+            # can't let you through, sleep until a higher priority packet or a resume
+            self.wait(True)
+            return
+        delay = pkt.size*8.0/self.rate
+        self.send_pkt(pkt)
+        self.env.schedule_port(self.finished, delay)
+
+    def send_pause(self, priority):
+        self.env.schedule(partial(self.start_delivery, self.deliver_pause, priority), 0, URGENT)
+
+    def send_resume(self):
+        self.env.schedule(partial(self.start_delivery, self.deliver_resume), 0, URGENT)
+
+    def start_delivery(self, deliver, *args):
+        self.env.schedule(partial(deliver, *args), self.env.timeout(self.link_delay))
+
+    def deliver_pause(self, priority):
+        for port in self.back:
+            port.receive_pause(self, priority)
+
+    def deliver_resume(self):
+        for port in self.back:
+            port.receive_resume(self)
+
+class KernelPacketSink(PacketSink):
+    """ A PacketSink run by a Kernel: packets are recorded as they are put """
+    def __init__(self, *args, **kwargs):
+        PacketSink.__init__(self, *args, **kwargs)
+        self.store = None  # nothing is ever put in it
+
+    def run(self):
+        return None
+
+    def put(self, pkt):
+        self.receive(pkt)
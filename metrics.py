@@ -0,0 +1,214 @@
+import os
+import time
+import threading
+import BaseHTTPServer
+from cache import write_atomic
+
+# Live metrics of the runs of this process, for watching long sweeps. Once
+# start()ed, an exporter publishes what the run under way is at every interval
+# seconds, in the Prometheus text format, over HTTP on a local port and/or to
+# a file (e.g. for the textfile collector of node_exporter):
+#
+#   python generate.py --sweep --metrics-port 9400
+#   curl localhost:9401/metrics
+#
+# Everything is done by a background thread reading the counters the monitor,
+# the pausing port and the sink keep anyway, so the simulation loop takes no
+# lock and does nothing more than without it. Events per second need an
+# environment that counts its events (a kernel.Kernel does, SimPy doesn't).
+
+# name, type, help, function of the run returning the value (None for none)
+METRICS = [
+    ('sim_time_seconds', 'gauge', "simulated time",
+     lambda run: run.env.now),
+    ('sim_wall_seconds', 'gauge', "wall time since the run started",
+     lambda run: time.time() - run.started),
+    ('sim_events_total', 'counter', "events processed",
+     lambda run: getattr(run.env, 'steps', None)),
+    ('sim_events_per_second', 'gauge', "events processed per wall second over the last interval",
+     lambda run: run.events_per_second),
+    ('sim_speed', 'gauge', "simulated seconds per wall second over the last interval",
+     lambda run: run.speed),
+    ('sim_queue_bytes', 'gauge', "bytes in the queue of the pausing port",
+     lambda run: run.port.byte_size),
+    ('sim_queue_packets', 'gauge', "packets in the queue of the pausing port",
+     lambda run: len(run.port.queue)),
+    ('sim_packets_received_total', 'counter', "packets that arrived at the pausing port",
+     lambda run: run.port.packets_rec),
+    ('sim_packets_dropped_total', 'counter', "packets the pausing port dropped",
+     lambda run: run.port.packets_drop),
+    ('sim_bytes_dropped_total', 'counter', "bytes the pausing port dropped",
+     lambda run: run.port.bytes_drop),
+    ('sim_packets_delivered_total', 'counter', "packets that reached the sink",
+     lambda run: run.port.out.packets_rec),
+    ('sim_pauses_sent_total', 'counter', "pauses the pausing port sent upstream",
+     lambda run: run.port.pauses_sent),
+    ('sim_resumes_sent_total', 'counter', "resumes the pausing port sent upstream",
+     lambda run: run.port.resumes_sent),
+    ('sim_pauses_active', 'gauge', "pauses of the pausing port in effect",
+     lambda run: len(run.port.pause_sent)),
+]
+
+class Run(object):
+    """ A run being watched: its environment and monitor, and its labels """
+    def __init__(self, env, monitor, labels):
+        self.env = env
+        self.port = monitor.port
+        self.labels = labels
+        self.started = time.time()
+        self.last = (self.started, env.now, getattr(env, 'steps', None))
+        self.events_per_second = None
+        self.speed = None
+
+    def measure(self):
+        """ Works out the rates since the last measure() """
+        now, sim_time, steps = time.time(), self.env.now, getattr(self.env, 'steps', None)
+        last_now, last_sim_time, last_steps = self.last
+        if now > last_now:
+            self.speed = (sim_time - last_sim_time) / (now - last_now)
+            if steps is not None:
+                self.events_per_second = (steps - last_steps) / (now - last_now)
+        self.last = (now, sim_time, steps)
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in sorted(labels.items())) + '}'
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        text = self.server.exporter.text
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(text)))
+        self.end_headers()
+        self.wfile.write(text)
+
+    def log_message(self, *args):
+        pass
+
+class MetricsExporter(object):
+    """ Publishes the metrics of the run being watched every interval seconds.
+
+        Parameters
+        ----------
+        port : int (or None)
+            local HTTP port to serve the metrics on
+        filename : string (or None)
+            file to write the metrics to, replaced as a whole each time
+        interval : float
+            wall seconds between updates
+        labels : dict
+            labels of every metric, e.g. the worker of a sweep
+    """
+    def __init__(self, port=None, filename=None, interval=1.0, labels=None):
+        self.port = port
+        self.filename = filename
+        self.interval = interval
+        self.labels = labels or {}
+        self.run = None
+        self.runs_finished = 0
+        self.text = ''
+        self.stopped = threading.Event()
+        self.threads = []
+        self.server = None
+
+    def start(self):
+        if self.port is not None:
+            self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', self.port), MetricsHandler)
+            self.server.exporter = self
+            self.threads.append(threading.Thread(target=self.server.serve_forever))
+        self.threads.append(threading.Thread(target=self.loop))
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        """ Stops the threads, leaving the last metrics in the file """
+        self.stopped.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        for thread in self.threads:
+            thread.join()
+        self.update()
+
+    def watch(self, env, monitor, labels):
+        """ Watches a run taking place in env, from now until unwatch() """
+        labels = dict(labels, **self.labels)
+        self.run = Run(env, monitor, labels)
+        self.update()
+
+    def unwatch(self):
+        self.run = None
+        self.runs_finished += 1
+        self.update()
+
+    def loop(self):
+        while not self.stopped.is_set():
+            self.stopped.wait(self.interval)
+            self.update()
+
+    def render(self):
+        """ Returns the metrics in the Prometheus text format """
+        lines = ['# HELP sim_runs_finished_total runs this process finished',
+                 '# TYPE sim_runs_finished_total counter',
+                 'sim_runs_finished_total{} {}'.format(format_labels(self.labels), self.runs_finished)]
+        run = self.run
+        if run is not None:
+            run.measure()
+            labels = format_labels(run.labels)
+            for name, kind, description, value in METRICS:
+                value = value(run)
+                if value is None:
+                    continue
+                lines.append('# HELP {} {}'.format(name, description))
+                lines.append('# TYPE {} {}'.format(name, kind))
+                lines.append('{}{} {!r}'.format(name, labels, value))
+        return '\n'.join(lines) + '\n'
+
+    def update(self):
+        self.text = self.render()
+        if self.filename is not None:
+            # readable by the textfile collector, which usually runs as another user
+            text = self.text
+            write_atomic(self.filename, lambda f: f.write(text), 'w')
+
+# the exporter of this process, if started
+exporter = None
+
+def start(port=None, filename=None, interval=1.0, workers=None):
+    """ Starts the exporter of this process. In the workers of a pool,
+        workers is a shared multiprocessing.Value counting them: the n-th
+        worker serves on port + n and writes to filename with .n before its
+        extension, and its metrics are labelled worker="n".
+    """
+    global exporter
+    labels = {}
+    if workers is not None:
+        with workers.get_lock():
+            workers.value += 1
+            worker = workers.value
+        labels['worker'] = worker
+        if port is not None:
+            port += worker
+        if filename is not None:
+            base, ext = os.path.splitext(filename)
+            filename = '{}.{}{}'.format(base, worker, ext)
+    exporter = MetricsExporter(port, filename, interval, labels)
+    exporter.start()
+
+def stop():
+    global exporter
+    if exporter is not None:
+        exporter.stop()
+        exporter = None
+
+def watch(env, monitor, labels):
+    if exporter is not None:
+        exporter.watch(env, monitor, labels)
+
+def unwatch():
+    if exporter is not None:
+        exporter.unwatch()
@@ -1,11 +1,18 @@
 import simpy
 import random
-import bisect
+import heapq
 import threading
+import array
+import numpy as np
+from bisect import insort
+from collections import deque
 from functools import total_ordering
 from enum import Enum
 import json
 import params
+import traces
+import workload
+from stats import Histogram, LogHistogram
 
 @total_ordering
 class Packet(object):
@@ -24,7 +31,13 @@ class Packet(object):
             identifiers for source and destination
         flow_id : int
             small integer that can be used to identify a flow
+
+        Use Packet.make() to get a packet from the free list, and release()
+        to give it back once nothing refers to it anymore.
     """
+    __slots__ = ['time', 'size', 'id', 'src', 'dst', 'flow_id', 'priority']
+    free = []
+
     def __init__(self, time, size, id, src="a", dst="z", flow_id=0, priority=0):
         self.time = time
         self.size = size
@@ -34,6 +47,23 @@ class Packet(object):
         self.flow_id = flow_id
         self.priority = priority
 
+    @classmethod
+    def make(cls, time, size, id, src="a", dst="z", flow_id=0, priority=0):
+        if not cls.free:
+            return cls(time, size, id, src, dst, flow_id, priority)
+        pkt = cls.free.pop()
+        pkt.time = time
+        pkt.size = size
+        pkt.id = id
+        pkt.src = src
+        pkt.dst = dst
+        pkt.flow_id = flow_id
+        pkt.priority = priority
+        return pkt
+
+    def release(self):
+        Packet.free.append(self)
+
     def __eq__(self, other):
         return self.priority == other.priority
 
@@ -62,11 +92,14 @@ class PacketGenerator(object):
             Starts generation after an initial delay. Default = 0
         finish : number
             Stops generation at the finish time. Default is infinite
+        dst : int
+            destination of the packets
 
 
     """
-    def __init__(self, env, id,  burst_size, burst_dist, sdist, initial_delay=0, finish=float("inf"), flow_id=0, priority=0):
+    def __init__(self, env, id,  burst_size, burst_dist, sdist, initial_delay=0, finish=float("inf"), flow_id=0, priority=0, dst="z"):
         self.id = id
+        self.dst = dst
         self.env = env
         self.burst_size = burst_size
         self.burst_dist = burst_dist
@@ -87,15 +120,187 @@ class PacketGenerator(object):
         while self.env.now < self.finish:
             # wait for next transmission
             yield self.env.timeout(self.burst_dist())
-            self.bursts += 1
-            for i in range(self.burst_size):
-                self.packets_sent += 1
-                p = Packet(self.env.now, self.sdist(), self.packets_sent, src=self.id, flow_id=self.flow_id, priority=self.priority)
-                self.out.put(p)
+            self.burst()
+
+    def burst(self):
+        """ Sends one burst of packets now """
+        self.bursts += 1
+        for i in range(self.burst_size):
+            self.packets_sent += 1
+            p = Packet.make(self.env.now, self.sdist(), self.packets_sent, src=self.id, dst=self.dst, flow_id=self.flow_id, priority=self.priority)
+            self.out.put(p)
+
+class MergedPacketGenerator(object):
+    """ Generates the packets of many Poisson sources from a single SimPy process.
+        The superposition of the sources is itself Poisson, so the time to the
+        next burst and the source that sends it are drawn directly, a block
+        at a time, from a seeded numpy RandomState, along with the packet sizes.
+        Set the "out" member variable to the entity to receive the packet.
+
+        Parameters
+        ----------
+        env : simpy.Environment
+            the simulation environment
+        ids : list
+            identifiers of the sources
+        priorities : list
+            the priority of the packets of each source
+        burst_size : int
+            number of packets in a burst
+        burst_interval : float
+            mean time between the bursts of one source
+        sdist : function
+            a function of n that returns the sizes of the next n packets
+        rng : numpy.random.RandomState
+            the source of randomness for this generator
+        block_size : int
+            number of bursts drawn at a time
+        initial_delay : number
+            Starts generation after an initial delay. Default = 0
+        finish : number
+            Stops generation at the finish time. Default is infinite
+        flow_ids : list
+            flow of each source, defaults to ids
+        dsts : list
+            destinations; each burst goes to one of them chosen uniformly. Default "z"
+
+    """
+    def __init__(self, env, ids, priorities, burst_size, burst_interval, sdist, rng, block_size=4096,
+                 initial_delay=0, finish=float("inf"), flow_ids=None, dsts=None):
+        self.ids = ids
+        self.env = env
+        self.priorities = priorities
+        self.burst_size = burst_size
+        self.burst_interval = burst_interval
+        self.sdist = sdist
+        self.rng = rng
+        self.block_size = block_size
+        self.initial_delay = initial_delay
+        self.finish = finish
+        self.flow_ids = flow_ids if flow_ids is not None else ids
+        self.dsts = dsts if dsts is not None else ["z"]
+        self.out = None
+        self.packets_sent = [0] * len(ids)
+        self.bursts = [0] * len(ids)
+        self.action = env.process(self.run())  # starts the run() method as a SimPy process
+
+    def run(self):
+        yield self.env.timeout(self.initial_delay)
+        while True:
+            self.draw_block()
+            for i in range(self.block_size):
+                if self.env.now >= self.finish:
+                    return
+                yield self.env.timeout(self.gaps[i])
+                self.burst(i)
+
+    def draw_block(self):
+        """ Draws the gaps, sources, packet sizes and destinations of the next block of bursts """
+        scale = self.burst_interval / len(self.ids)
+        self.gaps = self.rng.exponential(scale, self.block_size).tolist()
+        self.sources = self.rng.randint(0, len(self.ids), self.block_size).tolist()
+        self.sizes = list(self.sdist(self.block_size * self.burst_size))
+        if len(self.dsts) > 1:
+            self.block_dsts = self.rng.randint(0, len(self.dsts), self.block_size).tolist()
+        else:
+            self.block_dsts = [0] * self.block_size
+
+    def burst(self, i):
+        """ Sends burst i of the current block now """
+        src = self.sources[i]
+        self.bursts[src] += 1
+        for j in range(i * self.burst_size, (i + 1) * self.burst_size):
+            self.packets_sent[src] += 1
+            p = Packet.make(self.env.now, self.sizes[j], self.packets_sent[src], src=self.ids[src],
+                            dst=self.dsts[self.block_dsts[i]], flow_id=self.flow_ids[src], priority=self.priorities[src])
+            self.out.put(p)
+
+class WorkloadPacketGenerator(object):
+    """ Replays a workload file (see workload.py): sends each of its packets
+        at its time, with a priority from the remaining size of its flow as
+        in pFabric, the smaller the higher. The file is memory-mapped and
+        read block_size packets at a time, so it can be of any length.
+        Set the "out" member variable to the entity to receive the packet.
+
+        Parameters
+        ----------
+        env : simpy.Environment
+            the simulation environment
+        id : string
+            source of the packets
+        filename : string
+            the workload file
+        num_priorities : int
+            number of priority levels the remaining sizes are spread over
+        block_size : int
+            number of packets read at a time
+        initial_delay : number
+            Starts the workload after an initial delay. Default = 0
+        finish : number
+            Stops generation at the finish time. Default is infinite
+        dst : int
+            destination of the packets
+
+    """
+    def __init__(self, env, id, filename, num_priorities, block_size=4096, initial_delay=0, finish=float("inf"),
+                 dst="z"):
+        self.id = id
+        self.env = env
+        self.filename = filename
+        self.data = workload.open_workload(filename)
+        self.edges = workload.priority_edges(self.data, num_priorities)
+        self.block_size = block_size
+        self.initial_delay = initial_delay
+        self.finish = finish
+        self.dst = dst
+        self.out = None
+        self.next_row = 0  # first packet of the file not read yet
+        self.packets_sent = 0
+        self.action = env.process(self.run())  # starts the run() method as a SimPy process
+
+    def run(self):
+        while self.read_block():
+            for i in range(len(self.times)):
+                if self.env.now >= self.finish:
+                    return
+                yield self.env.timeout(self.delay(i))
+                self.send(i)
+
+    def read_block(self):
+        """ Reads the next block of packets, returns False at the end of the file """
+        rows = np.array(self.data[self.next_row:self.next_row + self.block_size])
+        self.next_row += len(rows)
+        self.times = (rows['time'] + self.initial_delay).tolist()
+        self.sizes = rows['size'].tolist()
+        self.flows = rows['flow'].tolist()
+        self.priorities = workload.priorities(rows['remaining'], self.edges).tolist()
+        return len(rows) > 0
+
+    def delay(self, i):
+        """ Returns the time until packet i of the current block """
+        return max(0.0, self.times[i] - self.env.now)
+
+    def send(self, i):
+        """ Sends packet i of the current block now """
+        self.packets_sent += 1
+        p = Packet.make(self.env.now, self.sizes[i], self.packets_sent, src=self.id, dst=self.dst,
+                        flow_id=self.flows[i], priority=self.priorities[i])
+        self.out.put(p)
+
+    def __getstate__(self):
+        # the memory map goes, the file is mapped again when unpickled
+        state = dict(self.__dict__)
+        del state['data']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.data = workload.open_workload(self.filename)
 
 class PacketSink(object):
     """ Receives packets and collects delay information into the
-        waits list. You can then use this list to look at delay statistics.
+        wait_stats histogram, overall and per priority in priority_wait_stats.
+        You can then use these to look at delay statistics at any time.
 
         Parameters
         ----------
@@ -104,48 +309,73 @@ class PacketSink(object):
         debug : boolean
             if true then the contents of each packet will be printed as it is received.
         rec_arrivals : boolean
-            if true then arrivals will be recorded
+            if true then arrivals will be recorded in arrival_stats
         absolute_arrivals : boolean
             if true absolute arrival times will be recorded, otherwise the time between consecutive arrivals
             is recorded.
         rec_waits : boolean
             if true waiting time experienced by each packet is recorded
+        keep_samples : boolean
+            if true every recorded value is also kept in the waits and arrivals lists
         selector: a function that takes a packet and returns a boolean
             used for selective statistics. Default none.
 
+        Packets are released for reuse once they have been counted.
+
     """
-    def __init__(self, env, rec_arrivals=False, absolute_arrivals=False, rec_waits=True, debug=False, selector=None):
+    def __init__(self, env, rec_arrivals=False, absolute_arrivals=False, rec_waits=True, debug=False, selector=None,
+                 keep_samples=False):
         self.store = simpy.Store(env)
         self.env = env
         self.rec_waits = rec_waits
         self.rec_arrivals = rec_arrivals
         self.absolute_arrivals = absolute_arrivals
+        self.keep_samples = keep_samples
+        self.wait_stats = LogHistogram()
+        self.priority_wait_stats = {}
+        self.arrival_stats = LogHistogram()
         self.waits = []
         self.arrivals = []
         self.debug = debug
+        self.last_arrival = 0.0
         self.action = env.process(self.run())  # starts the run() method as a SimPy process
         self.packets_rec = 0
         self.bytes_rec = 0
         self.selector = selector
 
     def run(self):
-        last_arrival = 0.0
         while True:
             msg = (yield self.store.get())
-            if not self.selector or self.selector(msg):
-                now = self.env.now
-                if self.rec_waits:
-                    self.waits.append(self.env.now - msg.time)
-                if self.rec_arrivals:
-                    if self.absolute_arrivals:
-                        self.arrivals.append(now)
-                    else:
-                        self.arrivals.append(now - last_arrival)
-                    last_arrival = now
-                self.packets_rec += 1
-                self.bytes_rec += msg.size
-                if self.debug:
-                    print "{}: \t sink: \t\t{}".format(self.env.now, msg)
+            self.receive(msg)
+
+    def receive(self, msg):
+        """ Records a packet that reached the sink and releases it """
+        if not self.selector or self.selector(msg):
+            now = self.env.now
+            if self.rec_waits:
+                wait = now - msg.time
+                key = self.wait_stats.key(wait)
+                self.wait_stats.add(wait, key)
+                stats = self.priority_wait_stats.get(msg.priority)
+                if stats is None:
+                    stats = self.priority_wait_stats[msg.priority] = LogHistogram()
+                stats.add(wait, key)
+                if self.keep_samples:
+                    self.waits.append(wait)
+            if self.rec_arrivals:
+                if self.absolute_arrivals:
+                    arrival = now
+                else:
+                    arrival = now - self.last_arrival
+                self.arrival_stats.add(arrival)
+                if self.keep_samples:
+                    self.arrivals.append(arrival)
+                self.last_arrival = now
+            self.packets_rec += 1
+            self.bytes_rec += msg.size
+            if self.debug:
+                print "{}: \t sink: \t\t{}".format(self.env.now, msg)
+        msg.release()
 
     def put(self, pkt):
         self.store.put(pkt)
@@ -155,22 +385,298 @@ class CheckpointAction(Enum):
     RESUME = 2
     NONE = 3
 
-@total_ordering
-class Checkpoint(object):
+class Checkpoints(object):
+    """ The checkpoints of a pausing port: thresholds on its queue size in
+        bytes, ascending in a NumPy array so the band of the queue between two
+        of them is found by binary search, each with a CheckpointAction, its
+        level (the priority a pause checkpoint pauses, None for the HRP of the
+        queue at the checkpoint below it) and whether it is active (the pause
+        sent when it was crossed is in effect). The first checkpoint is below
+        an empty queue and the last at the largest queue allowed. Resume and
+        pause checkpoints come in partners, the resume lifting the pause and
+        the pause reading the HRP at the resume, which need not be next to
+        each other when thresholds tie.
 
-    def __init__(self, thresh, action):
-        self.thresh = thresh
-        self.action = action
-        self.active = False
+        Parameters
+        ----------
+        thresholds : list
+            the thresholds in bytes, in any order (ties keep theirs)
+        actions : list
+            the CheckpointAction of each
+        levels : list (or None)
+            the level of each, all None if not given
+        partners : list (or None)
+            the index in thresholds of the partner of each (None for none), by
+            default the next checkpoint up of a resume and the one below a pause
+    """
+    def __init__(self, thresholds, actions, levels=None, partners=None):
+        order = np.argsort(thresholds, kind='mergesort')
+        position = dict((int(i), n) for n, i in enumerate(order))
+        if partners is None:
+            partners = [n + 1 if action == CheckpointAction.RESUME else n - 1 if action == CheckpointAction.PAUSE
+                        else None for n, action in enumerate(actions)]
+        self.partners = [position[partners[i]] if partners[i] is not None else None for i in order]
+        self.thresholds = np.asarray(thresholds, dtype=np.int64)[order]
+        self.values = self.thresholds.tolist()
+        self.actions = [actions[i] for i in order]
+        self.levels = [levels[i] for i in order] if levels is not None else [None] * len(order)
+        self.active = [False] * len(order)
 
-    def __lt__(self, other):
-        return self.thresh < other.thresh
+    def __len__(self):
+        return len(self.values)
 
-    def __eq__(self, other):
-        return self.thresh == other.thresh
+    def same(self, other):
+        """ Whether other has the same checkpoints, whichever are active """
+        return (self.values, self.actions, self.levels, self.partners) == \
+            (other.values, other.actions, other.levels, other.partners)
+
+    def band(self, byte_size):
+        """ Returns the checkpoint below a queue of byte_size bytes: the i with
+            thresholds[i] < byte_size <= thresholds[i+1], the last band if it
+            is above them all.
+        """
+        return min(int(np.searchsorted(self.thresholds, byte_size)), len(self.values) - 1) - 1
 
     def __repr__(self):
-        return "thresh: {}, action: {}, active: {}".format(self.thresh, self.action, self.active)
+        return "\n".join("thresh: {}, action: {}, level: {}, active: {}, partner: {}".format(*cp)
+                         for cp in zip(self.values, self.actions, self.levels, self.active, self.partners))
+
+class FenwickTree(object):
+    """ A binary indexed tree over non-negative integer keys that keeps prefix
+        sums of non-negative values. Grows to fit the largest key it is given.
+
+        Parameters
+        ----------
+        size : int
+            initial number of keys, rounded up to a power of two
+    """
+    def __init__(self, size=1):
+        self.size = 1
+        while self.size < size:
+            self.size *= 2
+        self.values = [0] * self.size
+        self.tree = [0] * (self.size + 1)
+
+    def grow(self, key):
+        size = self.size
+        while size <= key:
+            size *= 2
+        self.values.extend([0] * (size - self.size))
+        self.size = size
+        self.tree = [0] * (size + 1)
+        for i in range(size):
+            if self.values[i]:
+                self.update(i, self.values[i])
+
+    def add(self, key, delta):
+        if key >= self.size:
+            self.grow(key)
+        self.values[key] += delta
+        self.update(key, delta)
+
+    def update(self, key, delta):
+        i = key + 1
+        tree = self.tree
+        size = self.size
+        while i <= size:
+            tree[i] += delta
+            i += i & -i
+
+    def prefix(self, key):
+        """ Returns the sum of the values of keys 0 through key """
+        total = 0
+        i = min(key + 1, self.size)
+        tree = self.tree
+        while i > 0:
+            total += tree[i]
+            i -= i & -i
+        return total
+
+    def search(self, value, strict=True):
+        """ Returns the smallest key whose prefix sum is greater than value
+            (or, if strict is False, at least value). Returns size if there is none.
+        """
+        pos = 0
+        step = self.size
+        tree = self.tree
+        while step:
+            nxt = pos + step
+            if nxt <= self.size and (tree[nxt] <= value if strict else tree[nxt] < value):
+                pos = nxt
+                value -= tree[nxt]
+            step //= 2
+        return pos
+
+class PacketQueue(object):
+    """ A priority queue of packets kept as one FIFO deque per priority level.
+        The highest priority packet that arrived first is the next to leave,
+        and on overflow the lowest priority packet that arrived last is the
+        first to be dropped. Per-priority byte counts are kept up to date.
+
+        Members
+        -------
+        buckets : dict
+            priority -> deque of packets, oldest on the left
+        bytes : dict
+            priority -> total size in bytes of the packets queued at that priority
+        index : FenwickTree
+            the same byte counts, indexed for prefix sums over priority levels,
+            built by the first hrp() (None until then, so a queue that never
+            pauses doesn't keep it up) and brought up to date by every later
+            one. Priorities must be non-negative integers.
+        changed : set
+            the priorities whose byte count changed since the index was
+            last brought up to date
+        priorities : list
+            the priorities that have a bucket, in ascending order
+        top : int
+            the highest priority with a packet in the queue (-inf if empty)
+
+        Iterating goes through every packet, so what is queued at each
+        priority is read from bytes instead.
+
+    """
+    def __init__(self):
+        self.buckets = {}
+        self.bytes = {}
+        self.priorities = []
+        self.index = None
+        self.changed = set()
+        self.count = 0
+        self.top = float('-inf')
+        # heaps of the priorities that may be non-empty, pruned lazily
+        self.high = []
+        self.low = []
+        self.in_high = set()
+        self.in_low = set()
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for priority in self.priorities:
+            for pkt in self.buckets[priority]:
+                yield pkt
+
+    def append(self, pkt):
+        priority = pkt.priority
+        bucket = self.buckets.get(priority)
+        if bucket is None:
+            bucket = self.buckets[priority] = deque()
+            self.bytes[priority] = 0
+            insort(self.priorities, priority)
+        if priority not in self.in_high:
+            heapq.heappush(self.high, -priority)
+            self.in_high.add(priority)
+        if priority not in self.in_low:
+            heapq.heappush(self.low, priority)
+            self.in_low.add(priority)
+        bucket.append(pkt)
+        self.bytes[priority] += pkt.size
+        if self.index is not None:
+            self.changed.add(priority)
+        self.count += 1
+        if priority > self.top:
+            self.top = priority
+
+    def highest(self):
+        """ Returns the highest priority with a packet in the queue """
+        return self.top
+
+    def find_top(self):
+        """ Finds the highest priority with a packet after the top bucket emptied """
+        high = self.high
+        while high and not self.buckets[-high[0]]:
+            self.in_high.discard(-heapq.heappop(high))
+        self.top = -high[0] if high else float('-inf')
+
+    def lowest(self):
+        """ Returns the lowest priority with a packet in the queue """
+        while not self.buckets[self.low[0]]:
+            self.in_low.discard(heapq.heappop(self.low))
+        return self.low[0]
+
+    def peek(self):
+        """ Returns the next packet to be sent without removing it """
+        return self.buckets[self.top][0]
+
+    def pop(self):
+        """ Removes and returns the next packet to be sent """
+        priority = self.top
+        bucket = self.buckets[priority]
+        pkt = bucket.popleft()
+        self.bytes[priority] -= pkt.size
+        if self.index is not None:
+            self.changed.add(priority)
+        self.count -= 1
+        if not bucket:
+            self.find_top()
+        return pkt
+
+    def pop_tail(self):
+        """ Removes and returns the next packet to be dropped """
+        priority = self.lowest()
+        pkt = self.buckets[priority].pop()
+        self.bytes[priority] -= pkt.size
+        if self.index is not None:
+            self.changed.add(priority)
+        self.count -= 1
+        if priority == self.top and not self.buckets[priority]:
+            self.find_top()
+        return pkt
+
+    def hrp(self, threshold):
+        """ Walks the queue from the drop end (lowest priority, last arrival first)
+            until more than threshold bytes have been seen, and returns the priority
+            of the packet just before the one that crossed it. If the very first
+            packet crosses, the priority at the head of the queue is returned.
+            Returns -1 if the queue never holds more than threshold bytes.
+        """
+        if self.index is None:
+            self.index = FenwickTree()
+            self.changed = set(self.bytes)
+        index = self.index
+        for priority in self.changed:
+            size = self.bytes[priority] - (index.values[priority] if priority < index.size else 0)
+            if size:
+                index.add(priority, size)
+        self.changed.clear()
+        if not self.count or self.index.prefix(self.index.size - 1) <= threshold:
+            return -1
+        if threshold < 0:
+            return self.highest()
+        priority = self.index.search(threshold)
+        queue_size = self.index.prefix(priority) - self.bytes[priority]
+        if queue_size + self.buckets[priority][-1].size <= threshold:
+            return priority
+        # the first packet of this priority crosses the threshold
+        if queue_size == 0:
+            return self.highest()
+        return self.index.search(queue_size, strict=False)
+
+def make_checkpoints(packet_thresholds, packet_size, qlimit, levels=None):
+    """ Builds the Checkpoints of a pausing port with a buffer of qlimit
+        packets: resumes at the even and pauses at the odd entries of
+        packet_thresholds (in packets), with the levels of the pauses if given.
+    """
+    thresholds = [-1, qlimit * packet_size]
+    actions = [CheckpointAction.NONE, CheckpointAction.NONE]
+    pause_levels = [None, None]
+    partners = [None, None]
+    pairs = len(packet_thresholds) // 2
+    for n, r in enumerate(range(0, len(packet_thresholds), 2)):
+        # start with the resumes, the n-th resuming the n-th pause
+        thresholds.append(int(round(packet_thresholds[r] * packet_size)))
+        actions.append(CheckpointAction.RESUME)
+        pause_levels.append(None)
+        partners.append(2 + (len(packet_thresholds) + 1) // 2 + n if n < pairs else None)
+    for n, p in enumerate(range(1, len(packet_thresholds), 2)):
+        # then the pauses
+        thresholds.append(int(round(packet_thresholds[p] * packet_size)))
+        actions.append(CheckpointAction.PAUSE)
+        pause_levels.append(levels[n] if levels is not None else None)
+        partners.append(2 + n)
+    return Checkpoints(thresholds, actions, pause_levels, partners)
 
 class PrioritySwitchPort(object):
     """ Models a priority switch output port with a given rate and buffer size limit in bytes.
@@ -186,73 +692,93 @@ class PrioritySwitchPort(object):
             units of time it takes a pause/resume to reach this switch
         qlimit : integer (or None)
             a buffer size limit in bytes for the queue (does not include items in service).
+        drop_history : integer
+            how many of the most recently dropped packets are kept in drop_list
+        resume_offset : float
+            how far below the previous checkpoint, in bytes, the HRP of a pause is taken
+
+        back : list
+            the upstream ports that feed this port, which get its pauses and resumes
+        pause_log : PauseLog (or None)
+            where the pauses and resumes this port sends and receives are recorded
 
         out must be initialized before simulation
         if pause is set:
-            link_delay, back, checkpoints must also be initialized
+            back must also be initialized, and qlimit, link_delay,
+            resume_offset and the checkpoints set, by configure() or by hand
 
     """
-    def __init__(self, env, rate, qlimit=None, pause=False, debug=False):
-        self.queue = []
-        self.store = simpy.Store(env) # used only for a count of items in the queue
+    def __init__(self, env, rate, qlimit=None, pause=False, debug=False, drop_history=1000):
+        self.queue = PacketQueue()
         self.rate = rate
         self.link_delay = 0
+        self.resume_offset = 0
         self.env = env
         self.out = None
-        self.back = None
+        self.back = []
         self.packets_rec = 0
         self.packets_drop = 0
-        self.drop_list = []
+        self.bytes_drop = 0
+        self.drop_list = deque(maxlen=drop_history)
         self.qlimit = qlimit
         self.byte_size = 0  # Current size of the queue in bytes
         self.debug = debug
         self.pause = pause
         self.pause_sent = []
-        self.pause_rec = []
-        self.checkpoints = []
+        self.pauses_sent = 0  # pauses sent upstream so far, and resumes
+        self.resumes_sent = 0
+        self.pause_rec = {}  # downstream port -> stack of the pauses it has in effect here
+        self.pause_level = None  # highest priority paused by any downstream port
+        self.checkpoints = None
         self.prev_cp = 0
         self.next_cp = 1
+        self.low = None  # threshold of the previous checkpoint
+        self.high = None  # threshold of the next checkpoint
         self.busy = 0  # Used to track if a packet is currently being sent
-        self.unpause_check = env.event()
+        self.waiting = None  # event the transmitter is blocked on, if any
+        self.waiting_unpause = False  # whether it is blocked by a pause rather than an empty queue
+        self.pause_log = None
         self.action = env.process(self.run())  # starts the run() method as a SimPy process
 
     def run(self):
         while True:
-            msg = (yield self.store.get())
+            if not self.queue:
+                # sleep until put() hands us a packet
+                yield self.wait(False)
+            elif self.env.peek() <= self.env.now:
+                # let everything else happening at this instant go first
+                yield self.env.timeout(0)
             self.busy = 1
-            pkt = self.queue[-1]
+            pkt = self.queue.peek()
             if self.pause_rec:
                 # something's paused, need to check
-                if pkt.priority > self.pause_rec[-1]:
+                if pkt.priority > self.pause_level:
                     # alright, important enough to let through
                     self.send_pkt(pkt)
                     yield self.env.timeout(pkt.size*8.0/self.rate)
                 else:
-                    # can't let you through, putting token back into the store
-                    self.store.put(pkt)
-                    yield self.unpause_check
+                    # can't let you through, sleep until a higher priority packet or a resume
+                    yield self.wait(True)
             else:
                 self.send_pkt(pkt)
                 yield self.env.timeout(pkt.size*8.0/self.rate)
             self.busy = 0
 
+    def wait(self, unpause):
+        self.waiting = self.env.event()
+        self.waiting_unpause = unpause
+        return self.waiting
+
+    def wake(self):
+        waiting, self.waiting = self.waiting, None
+        waiting.succeed()
+
     def send_pkt(self, pkt):
         pkt = self.queue.pop()
         self.byte_size -= pkt.size
-        if self.pause:
-            prev_cp = self.checkpoints[self.prev_cp]
-            next_cp = self.checkpoints[self.next_cp]
-            if self.byte_size <= prev_cp.thresh:
-                # dipped below a threshold
-                if prev_cp.action == CheckpointAction.RESUME:
-                    if next_cp.active:
-                        # need to send resume upstream
-                        self.checkpoints[self.next_cp].active = False
-                        self.pause_sent.pop()
-                        self.env.process(self.send_resume())
-                # regardless need to update prev and next pointers
-                self.prev_cp -= 1
-                self.next_cp -= 1
+        if self.pause and self.byte_size <= self.low:
+            # dipped below a threshold
+            self.cross()
         self.out.put(pkt)
 
     def put(self, pkt):
@@ -260,77 +786,148 @@ class PrioritySwitchPort(object):
             print "{}: {}".format(self.env.now, pkt)
         self.packets_rec += 1
         self.byte_size += pkt.size
-        if self.queue:
-            if pkt.priority > self.queue[-1].priority:
-                self.unpause_check.succeed()
-                self.unpause_check = self.env.event()
-        bisect.insort_left(self.queue, pkt)
-        self.store.put(pkt)
+        if self.waiting is not None and self.waiting_unpause:
+            if pkt.priority > self.queue.highest():
+                # this packet can go ahead of the paused ones
+                self.wake()
+        self.queue.append(pkt)
+        if self.waiting is not None and not self.waiting_unpause:
+            # the transmitter is idle, this packet wakes it up
+            self.wake()
 
         if self.qlimit is None:
             return
 
         while (self.byte_size > self.qlimit):
-            msg = self.store.get()
             self.packets_drop += 1
-            self.byte_size -= self.queue[0].size
-            self.drop_list.append(self.queue[0])
-            del self.queue[0]
-
-        if self.pause:
-            prev_cp = self.checkpoints[self.prev_cp]
-            next_cp = self.checkpoints[self.next_cp]
-            if self.byte_size <= prev_cp.thresh:
-                # dipped below a threshold
-                # this is very unlikely
-                if prev_cp.action == CheckpointAction.RESUME:
-                    if next_cp.active:    
-                        # need to send resume upstream
-                        self.checkpoints[self.next_cp].active = False
-                        self.pause_sent.pop()
-                        self.env.process(self.send_resume())
-                # regardless need to update pointers
-                self.prev_cp -= 1
-                self.next_cp -= 1
-            elif self.byte_size > next_cp.thresh:
-                # hit the next threshold
-                if next_cp.action == CheckpointAction.PAUSE:
-                    if not next_cp.active:
-                        # need to send pause upstream:
-                            # to determine the pause value, we need to determine what the highest remaining priority will be 
-                            # when we eventually resume this pause
-                            # so we check the value of the packet in the queue 'at' the resume threshold (with small technicalities)
-                        resume_threshold = prev_cp.thresh - params.B * params.packet_size
-                        queue_size = 0
-                        hrp = -1
-                        for i in range(len(self.queue)):
-                            queue_size += self.queue[i].size
-                            if queue_size > resume_threshold:
-                                # then this packet is the HRP
-                                hrp = self.queue[i-1].priority
-                                break
-                        self.checkpoints[self.next_cp].active = True
-                        self.pause_sent.append(hrp)
-                        self.env.process(self.send_pause(hrp))
-                # regardless need to update pointers
-                self.prev_cp += 1
-                self.next_cp += 1
+            dropped = self.queue.pop_tail()
+            self.byte_size -= dropped.size
+            self.bytes_drop += dropped.size
+            self.drop_list.append(dropped)
+
+        if self.pause and not self.low < self.byte_size <= self.high:
+            # dipped below a threshold (very unlikely) or hit the next one
+            self.cross()
         return
 
+    def cross(self):
+        """ Moves the checkpoint pointers to the band of the current queue size,
+            however many checkpoints away, acting on every checkpoint crossed
+            in the order it is crossed: resumes for the resume checkpoints
+            below an active pause on the way down, pauses for the inactive
+            pause checkpoints on the way up.
+        """
+        checkpoints = self.checkpoints
+        band = checkpoints.band(self.byte_size)
+        for i in range(self.prev_cp, band, -1):
+            pause = checkpoints.partners[i]
+            if checkpoints.actions[i] == CheckpointAction.RESUME and pause is not None and checkpoints.active[pause]:
+                # need to send resume upstream
+                checkpoints.active[pause] = False
+                self.resume_upstream()
+        for i in range(self.next_cp, band + 1):
+            if checkpoints.actions[i] == CheckpointAction.PAUSE and not checkpoints.active[i]:
+                checkpoints.active[i] = True
+                self.pause_upstream(self.pause_priority(i))
+        self.enter_band(band)
+
+    def enter_band(self, band):
+        self.prev_cp = band
+        self.next_cp = band + 1
+        self.low = self.checkpoints.values[band]
+        self.high = self.checkpoints.values[band + 1]
+
+    def pause_priority(self, i):
+        """ Returns the priority to pause at pause checkpoint i """
+        level = self.checkpoints.levels[i]
+        if level is not None:
+            return level
+        # to determine the pause value, we need to determine what the highest remaining priority will be
+        # when we eventually resume this pause
+        # so we check the value of the packet in the queue 'at' the resume threshold (with small technicalities)
+        return self.queue.hrp(self.checkpoints.values[self.checkpoints.partners[i]] - self.resume_offset)
+
+    def pause_upstream(self, hrp):
+        self.pause_sent.append(hrp)
+        self.pauses_sent += 1
+        if self.pause_log is not None:
+            self.pause_log.sent(self, CheckpointAction.PAUSE, hrp)
+        self.env.process(self.send_pause(hrp))
+
+    def resume_upstream(self):
+        hrp = self.pause_sent.pop()
+        self.resumes_sent += 1
+        if self.pause_log is not None:
+            self.pause_log.sent(self, CheckpointAction.RESUME, hrp)
+        self.env.process(self.send_resume())
+
+    def configure(self, config):
+        """ Sets qlimit, link_delay, resume_offset and the checkpoints of a
+            pausing port from a params.SimulationConfig. In the middle of a run
+            the checkpoints are only replaced if config changes them.
+        """
+        self.qlimit = config.qlimit * config.packet_size
+        self.link_delay = config.link_delay
+        self.resume_offset = config.B * config.packet_size
+        checkpoints = make_checkpoints(config.packet_thresholds, config.packet_size, config.qlimit,
+                                       config.pause_levels)
+        if self.checkpoints is None or not checkpoints.same(self.checkpoints):
+            self.set_checkpoints(checkpoints)
+
+    def set_checkpoints(self, checkpoints):
+        """ Sets the Checkpoints of the port, also in the middle of a run, leaving
+            the port as it would be had it always had them: the pointers are moved
+            around the current queue size, the pauses in effect are handed to the
+            pause checkpoints below it from the bottom up, those left over are
+            resumed and the pause checkpoints left without one send theirs now.
+        """
+        self.checkpoints = checkpoints
+        band = checkpoints.band(self.byte_size)
+        crossed = [i for i in range(band + 1) if checkpoints.actions[i] == CheckpointAction.PAUSE]
+        while len(self.pause_sent) > len(crossed):
+            self.resume_upstream()
+        for n, i in enumerate(crossed):
+            checkpoints.active[i] = True
+            if n >= len(self.pause_sent):
+                self.pause_upstream(self.pause_priority(i))
+        self.enter_band(band)
+
     def send_pause(self, priority):
         yield self.env.timeout(self.link_delay)
-        self.back.pause_rec.append(priority)
+        for port in self.back:
+            port.receive_pause(self, priority)
 
     def send_resume(self):
         yield self.env.timeout(self.link_delay)
-        self.back.pause_rec.pop()
-        self.back.unpause_check.succeed()
-        self.back.unpause_check = self.env.event()
+        for port in self.back:
+            port.receive_resume(self)
+
+    def receive_pause(self, sender, priority):
+        self.pause_rec.setdefault(sender, []).append(priority)
+        self.pause_level = max(pauses[-1] for pauses in self.pause_rec.values())
+        if self.pause_log is not None:
+            self.pause_log.paused(self, self.pause_level)
+
+    def receive_resume(self, sender):
+        pauses = self.pause_rec[sender]
+        pauses.pop()
+        if not pauses:
+            del self.pause_rec[sender]
+        if self.pause_rec:
+            self.pause_level = max(pauses[-1] for pauses in self.pause_rec.values())
+        else:
+            self.pause_level = None
+        if self.pause_log is not None:
+            self.pause_log.paused(self, self.pause_level)
+        if self.waiting is not None and self.waiting_unpause:
+            self.wake()
 
 class PortMonitor(object):
-    """ A monitor for a SwitchPort. Looks at the number of items in the SwitchPort
-        in service + in the queue and records that info in the sizes[] list. The
-        monitor looks at the port at time intervals given by the distribution dist.
+    """ A monitor for a SwitchPort. Looks at the number of bytes in the SwitchPort
+        queue and records that info in the queue_stats histogram, and if
+        priority_stats is set the bytes queued at each priority in the
+        priority_queue_stats histograms. The monitor looks at the port at
+        time intervals given by the distribution dist.
 
         Parameters
         ----------
@@ -340,47 +937,157 @@ class PortMonitor(object):
             the switch port object to be monitored.
         dist : function
             a no parameter function that returns the successive inter-lookup times
-        trace : file
-            the file where the trace will be recorded
+        trace : string
+            the file where the trace will be recorded, binary if it ends in .npy
+            and tab separated text otherwise
+        priorities : list
+            the priority levels broken out in the queue makeup of the trace
+        delim : string
+            field delimiter of a text trace
+        keep_samples : boolean
+            if true every queue size is also kept in the queue_sizes list
+        priority_stats : boolean
+            if true the bytes queued at each of priorities are recorded in
+            priority_queue_stats, a dict of priority -> Histogram. Each sample
+            then costs O(P) even without a trace.
+
+        close() must be called at the end of the simulation to flush the trace
 
     """
-    def __init__(self, env, port, dist, trace, debug):
+    def __init__(self, env, port, dist, trace, debug, priorities=params.priorities, delim=params.trace_delim,
+                 keep_samples=False, priority_stats=False):
         self.port = port
         self.env = env
         self.dist = dist
         self.trace = trace
         self.debug = debug
+        self.priorities = priorities
+        self.keep_samples = keep_samples
+        self.queue_stats = Histogram()
         self.queue_sizes = []
+        self.priority_queue_stats = None
+        if priority_stats:
+            self.priority_queue_stats = dict((priority, Histogram()) for priority in priorities)
+        self.tr = None
+        if self.debug:
+            self.tr = traces.open_trace(self.trace, len(self.priorities), delim)
         self.action = env.process(self.run())
 
     def run(self):
+        while True:
+            yield self.env.timeout(self.dist())
+            self.sample()
+
+    def sample(self):
+        """ Looks at the port now """
+        if self.debug or self.priority_queue_stats is not None:
+            queued = self.port.queue.bytes
+            q_makeup = [queued.get(priority, 0) for priority in self.priorities]
+        if self.priority_queue_stats is not None:
+            for priority, size in zip(self.priorities, q_makeup):
+                self.priority_queue_stats[priority].add(size)
         if self.debug:
-            with open(self.trace, 'w') as tr:
-                while True:
-                    yield self.env.timeout(self.dist())
-                    q_makeup = []
-                    for priority in params.priorities:
-                        subqueue = [pkt.size if (pkt.priority == priority) else 0 for pkt in self.port.queue]
-                        q_makeup.append(sum(subqueue))
-
-                    tr.write(str(self.env.now))
-                    tr.write(params.trace_delim)
-                    tr.write(str(self.port.byte_size))
-                    tr.write(params.trace_delim)
-                    for i in range(len(params.priorities)):
-                        tr.write(str(q_makeup[i]))
-                        tr.write(params.trace_delim)
-                    if self.port.pause_sent:
-                        tr.write(str(self.port.pause_sent[-1]))
-                    else:
-                        tr.write(str(-1))
-                    tr.write(params.trace_delim)
-                    tr.write(str(self.port.packets_drop))
-                    tr.write("\n")
+            if self.port.pause_sent:
+                pause = self.port.pause_sent[-1]
+            else:
+                pause = -1
+            self.tr.write(self.env.now, self.port.byte_size, q_makeup, pause, self.port.packets_drop)
+        self.queue_stats.add(self.port.byte_size)
+        if self.keep_samples:
+            self.queue_sizes.append(self.port.byte_size)
 
-        else:
-            while True:
-                yield self.env.timeout(self.dist())
-                self.queue_sizes.append(self.port.byte_size)
-            
-            
\ No newline at end of file
+    def close(self):
+        if self.tr:
+            self.tr.close()
+
+class PauseLog(object):
+    """ An exact record of the pauses and resumes of a set of ports, kept in
+        compact arrays rather than sampled like a trace. Set the pause_log
+        member of every port to record to this log.
+
+        Every pause or resume a port sends is logged as (time, port, action, HRP):
+        port is the number given to the port by name(), action the value of a
+        CheckpointAction and HRP the highest paused priority (the one being
+        lifted for a resume).
+
+        Each port that receives pauses also adds up how long it spends with
+        each highest paused priority, so for every priority p the log knows how
+        long p was held back (head-of-line blocking) and by how many pauses.
+        Call finish() at the end of the simulation to count the pauses still in effect.
+    """
+    def __init__(self):
+        self.ports = {}  # port -> number in the log
+        self.names = []
+        self.times = array.array('d')
+        self.port_ids = array.array('i')
+        self.actions = array.array('b')
+        self.hrps = array.array('l')
+        self.pause_counts = {}  # HRP -> pauses sent with it
+        self.level_time = {}  # highest paused priority -> time spent under it
+        self.levels = {}  # receiving port -> (highest paused priority or None, since when)
+
+    def name(self, port, name=None):
+        """ Returns the number of a port in the log, giving it one (and name) if it is new """
+        if port not in self.ports:
+            self.ports[port] = len(self.names)
+            self.names.append(name if name is not None else str(len(self.names)))
+        return self.ports[port]
+
+    def sent(self, port, action, hrp):
+        self.times.append(port.env.now)
+        self.port_ids.append(self.name(port))
+        self.actions.append(action.value)
+        self.hrps.append(hrp)
+        if action == CheckpointAction.PAUSE:
+            self.pause_counts[hrp] = self.pause_counts.get(hrp, 0) + 1
+
+    def paused(self, port, level):
+        """ Records that everything up to priority level (None for nothing) is now paused at port """
+        now = port.env.now
+        previous, since = self.levels.get(port, (None, now))
+        if previous is not None:
+            self.level_time[previous] = self.level_time.get(previous, 0.0) + now - since
+        self.levels[port] = (level, now)
+
+    def finish(self, now):
+        for port, (level, since) in self.levels.items():
+            if level is not None:
+                self.level_time[level] = self.level_time.get(level, 0.0) + now - since
+            self.levels[port] = (level, now)
+
+    def events(self):
+        """ Returns the event log as a structured array """
+        events = np.zeros(len(self.times), dtype=[('time', '<f8'), ('port', '<i4'), ('action', 'i1'), ('hrp', '<i8')])
+        events['time'] = self.times
+        events['port'] = self.port_ids
+        events['action'] = self.actions
+        events['hrp'] = self.hrps
+        return events
+
+    def priority_totals(self, num_priorities):
+        """ Returns (paused time, pauses) per priority: how long each priority
+            was held back, summed over the receiving ports, and how many pauses
+            held it back. A pause with HRP h holds back every priority up to h.
+        """
+        paused_time = np.zeros(num_priorities + 1)
+        pauses = np.zeros(num_priorities + 1, dtype=np.int64)
+        for level, seconds in self.level_time.items():
+            if level >= 0:
+                paused_time[min(level, num_priorities - 1)] += seconds
+        for hrp, count in self.pause_counts.items():
+            if hrp >= 0:
+                pauses[min(hrp, num_priorities - 1)] += count
+        # a priority is held back by every pause at or above it
+        return paused_time[::-1].cumsum()[::-1][:-1], pauses[::-1].cumsum()[::-1][:-1]
+
+    def save(self, filename, num_priorities):
+        """ Writes the event log to a .npy file and the port names and per
+            priority totals next to it (.json)
+        """
+        np.save(filename, self.events())
+        paused_time, pauses = self.priority_totals(num_priorities)
+        with open(filename.rsplit('.', 1)[0] + '.json', 'w') as f:
+            json.dump({'ports': self.names,
+                       'actions': dict((action.value, action.name) for action in CheckpointAction),
+                       'paused_time': paused_time.tolist(),
+                       'pauses': pauses.tolist()}, f, indent=2, sort_keys=True)
@@ -1,3 +1,5 @@
+import thresholds
+
 ## Experiment parameters -------------------------
 
 sim_duration = 2.0
@@ -7,7 +9,13 @@ priorities = range(num_priorities)
 qlimit = 1000
 first_pause = 0.1
 B = 10
+# how the thresholds are spaced: "linear", "geometric", "per_priority" or "file" (see thresholds.py)
+threshold_schedule = "linear"
+threshold_ratio = 1.25  # between consecutive thresholds of a geometric schedule
+threshold_file = None
 packet_thresholds = range(int(first_pause * qlimit), qlimit, 2*B)
+# priority paused at each pause threshold, None for the HRP of the queue
+pause_levels = None
 byte_thresholds = [packet_size * x for x in packet_thresholds]
 
 burst_size = 1 #packets
@@ -15,6 +23,13 @@ k = 0.9
 output_rate = 800000000 #bits/s = 0.1 Gb/s
 input_rate = output_rate * 1000
 burst_interval = (len(priorities) * burst_size * packet_size) / (k * output_rate / 8)
+# draw all arrivals from one merged Poisson stream instead of a process per priority
+batch_arrivals = False
+# a workload file (see workload.py) to replay instead of the Poisson bursts, None for those
+workload = None
+# event loop of simulate(): "simpy", or "kernel" for the one of kernel.py, which gives the
+# same results and is the one runs can be snapshotted in
+engine = "simpy"
 
 
 
@@ -22,9 +37,108 @@ link_delay = (B * packet_size * 8) / input_rate
 trace_rate = 0.0001
 percentile = 95.0
 repetitions = 10
-trace = "queue.tr"
+# steady state mode: cut the warm-up off the samples and run until the
+# percentile is known well enough instead of for sim_duration (see steady.py)
+steady_state = False
+steady_precision = 0.05  # relative half width of the confidence interval to reach (or half a packet)
+steady_confidence = 0.95
+steady_batches = 20
+steady_check = 0.1  # simulated seconds between checks
+steady_max_duration = 20.0
+# simulated seconds between snapshots of a run that is given somewhere to save them, or
+# of every run in a sweep with a cache, to go on from if it is stopped (None for none);
+# only runs with engine = "kernel" are snapshotted
+snapshot_interval = None
+trace = "queue.npy"
 exp_path = "results/exp8/"
 exp_trace = "exp.tr"
 exp_priorities = [1, 5, 10, 50, 100, 500, 1000, 5000, 10000]
 trace_delim = "\t"
-seed = range(repetitions)
\ No newline at end of file
+seed = range(repetitions)
+
+## Simulation config -----------------------------
+
+class SimulationConfig(object):
+    """ A self-contained copy of the experiment parameters above, so several
+        differently configured simulations can run in one process.
+        Any parameter can be overridden by keyword. A derived parameter
+        (priorities, thresholds, input_rate, burst_interval, link_delay, seed) keeps
+        its value from this file unless one of the parameters it is computed
+        from is overridden, in which case it is recomputed.
+
+        Use replace() to get a config with further overrides applied.
+    """
+    BASE = ['sim_duration', 'packet_size', 'num_priorities', 'qlimit', 'first_pause', 'B',
+            'threshold_schedule', 'threshold_ratio', 'threshold_file',
+            'burst_size', 'batch_arrivals', 'workload', 'engine', 'k', 'output_rate', 'trace_rate', 'percentile', 'repetitions',
+            'steady_state', 'steady_precision', 'steady_confidence', 'steady_batches', 'steady_check',
+            'steady_max_duration', 'snapshot_interval',
+            'trace', 'exp_path', 'exp_trace', 'exp_priorities', 'trace_delim']
+    # in dependency order, each with the parameters it is computed from
+    DERIVED = [('priorities', ['num_priorities']),
+               ('packet_thresholds', ['first_pause', 'qlimit', 'B', 'threshold_schedule', 'threshold_ratio',
+                                      'threshold_file', 'num_priorities']),
+               ('pause_levels', ['threshold_schedule', 'threshold_file', 'num_priorities']),
+               ('byte_thresholds', ['packet_size', 'packet_thresholds']),
+               ('input_rate', ['output_rate']),
+               ('burst_interval', ['priorities', 'burst_size', 'packet_size', 'k', 'output_rate']),
+               ('link_delay', ['B', 'packet_size', 'input_rate']),
+               ('seed', ['repetitions'])]
+
+    def __init__(self, **overrides):
+        defaults = globals()
+        derived = [name for name, inputs in self.DERIVED]
+        for name in overrides:
+            if name not in self.BASE and name not in derived:
+                raise TypeError("unknown parameter: {}".format(name))
+        self.overrides = overrides
+        for name in self.BASE:
+            setattr(self, name, overrides.get(name, defaults[name]))
+        changed = set(overrides)
+        for name, inputs in self.DERIVED:
+            if name in overrides:
+                value = overrides[name]
+            elif changed.intersection(inputs):
+                value = getattr(self, 'derive_' + name)()
+                changed.add(name)
+            else:
+                value = defaults[name]
+            setattr(self, name, value)
+
+    def derive_priorities(self):
+        return range(self.num_priorities)
+
+    def derive_packet_thresholds(self):
+        return thresholds.schedule(self)[0]
+
+    def derive_pause_levels(self):
+        return thresholds.schedule(self)[1]
+
+    def derive_byte_thresholds(self):
+        return [self.packet_size * x for x in self.packet_thresholds]
+
+    def derive_input_rate(self):
+        return self.output_rate * 1000
+
+    def derive_burst_interval(self):
+        return (len(self.priorities) * self.burst_size * self.packet_size) / (self.k * self.output_rate / 8)
+
+    def derive_link_delay(self):
+        return (self.B * self.packet_size * 8) / self.input_rate
+
+    def derive_seed(self):
+        return range(self.repetitions)
+
+    def as_dict(self):
+        """ Returns every parameter, base and derived, by name """
+        names = self.BASE + [name for name, inputs in self.DERIVED]
+        return dict((name, getattr(self, name)) for name in names)
+
+    def replace(self, **overrides):
+        merged = dict(self.overrides)
+        merged.update(overrides)
+        return SimulationConfig(**merged)
+
+    def __repr__(self):
+        return "SimulationConfig({})".format(", ".join(
+            "{}={!r}".format(name, self.overrides[name]) for name in sorted(self.overrides)))
@@ -0,0 +1,143 @@
+import os
+import glob
+import argparse
+import multiprocessing
+import matplotlib
+matplotlib.use('Agg')  # no display needed, figures only go to files
+import matplotlib.pyplot as plt
+import numpy as np
+import params
+import traces
+
+# Batch, headless version of the sweep plots of analyze.py: every
+# results/exp*/exp.tr gets its percentile and max queue size plots and a
+# summary table, rendered in parallel.
+#
+#   python report.py [results] [--processes N]
+
+def load_params(filename):
+    """ Reads the parameters recorded in a params.txt. Older ones were written by
+        hand as lines of params.py, so each line is run on its own and the
+        ones that don't run are skipped.
+    """
+    values = {}
+    if not os.path.exists(filename):
+        return values
+    with open(filename) as f:
+        for line in f:
+            try:
+                exec line in {}, values
+            except Exception:
+                pass
+    return values
+
+def load_sweep(filename, delim=params.trace_delim):
+    """ Reads a sweep table as (number of priorities, percentile sizes, max sizes),
+        with a column per repetition. Old tables without max sizes give None.
+    """
+    data = np.loadtxt(filename, delimiter=delim, ndmin=2)
+    values = data[:, 1:]
+    if values.shape[1] % 2:
+        return data[:, 0], values, None
+    return data[:, 0], values[:, 0::2], values[:, 1::2]
+
+def summarize(sweep):
+    """ Returns the rows of the summary table of a sweep: number of priorities,
+        mean and std of the percentile and of the max queue size.
+    """
+    nums, percentiles, maxes = sweep
+    columns = [nums, percentiles.mean(axis=1), percentiles.std(axis=1)]
+    if maxes is not None:
+        columns += [maxes.mean(axis=1), maxes.std(axis=1)]
+    return np.column_stack(columns)
+
+def write_summary(summary, filename, delim=params.trace_delim):
+    header = ['priorities', 'percentile_mean', 'percentile_std', 'max_mean', 'max_std'][:summary.shape[1]]
+    with open(filename, 'w') as f:
+        f.write(delim.join(header) + '\n')
+        for row in summary:
+            f.write(delim.join(repr(float(x)) for x in row) + '\n')
+
+def plot_sweep(job):
+    """ Renders one sweep figure: (png file, x values, means, stds, thresholds, ylabel, log x) """
+    filename, nums, means, stds, thresholds, ylabel, log = job
+    fig = plt.figure()
+    plt.errorbar(np.log(nums) if log else nums, means, yerr=stds)
+    for thresh in thresholds:
+        plt.axhline(y=thresh, linewidth=1, alpha=0.4)
+    plt.title('Queue occupancies across priority levels')
+    plt.xlabel('log(priority levels)' if log else 'Priority levels')
+    plt.ylabel(ylabel)
+    plt.savefig(filename, bbox_inches='tight')
+    plt.close(fig)
+    return filename
+
+def plot_trace(job):
+    """ Renders the queue makeup and pauses of a trace: (png file, trace file, thresholds) """
+    filename, trace, thresholds = job
+    fig, axarr = plt.subplots(2, sharex=True)
+    # the min and max of every makeup column in every pixel column, which stack into a span
+    trace_data = traces.decimate_trace(trace, int(fig.get_figwidth() * fig.dpi))
+    for thresh in thresholds:
+        axarr[0].axhline(y=thresh, linewidth=1, alpha=0.4)
+    axarr[0].stackplot(trace_data['time'], np.transpose(trace_data['makeup']))
+    axarr[0].set_title('Makeup of queue')
+    axarr[0].set_ylabel('size (bytes)')
+    axarr[1].plot(trace_data['time'], trace_data['pause'])
+    axarr[1].set_title('Pauses sent')
+    axarr[1].set_xlabel('time (s)')
+    axarr[1].set_ylabel('Pause threshold')
+    plt.savefig(filename, bbox_inches='tight')
+    plt.close(fig)
+    return filename
+
+def render(job):
+    kind = job[0]
+    if kind == 'sweep':
+        return plot_sweep(job[1:])
+    return plot_trace(job[1:])
+
+def experiment_jobs(path):
+    """ Writes the summary table of one results directory and returns its figure jobs """
+    recorded = load_params(os.path.join(path, 'params.txt'))
+    if 'byte_thresholds' in recorded:
+        thresholds = recorded['byte_thresholds'][1::2]
+    else:
+        thresholds = params.byte_thresholds[1::2]
+    jobs = []
+    exp_trace = os.path.join(path, recorded.get('exp_trace', params.exp_trace))
+    if os.path.exists(exp_trace):
+        summary = summarize(load_sweep(exp_trace))
+        write_summary(summary, os.path.join(path, 'summary.tsv'))
+        nums = summary[:, 0]
+        figures = [('percentile', '{:g}th percentile queue size (bytes)'.format(recorded.get('percentile', params.percentile)), 1)]
+        if summary.shape[1] > 3:
+            figures.append(('max', 'Max queue size (bytes)', 3))
+        for name, ylabel, column in figures:
+            for log in (False, True):
+                filename = os.path.join(path, '{}{}_queue_sizes.png'.format('log_' if log else '', name))
+                jobs.append(('sweep', filename, nums, summary[:, column], summary[:, column + 1], thresholds, ylabel, log))
+    for trace in sorted(glob.glob(os.path.join(path, 'queue.npy')) + glob.glob(os.path.join(path, 'queue.tr'))):
+        jobs.append(('trace', os.path.splitext(trace)[0] + '_makeup.png', trace, thresholds))
+    return jobs
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render the plots of every results/exp* directory without a display.")
+    parser.add_argument('results', nargs='?', default='results', help="directory holding the exp* directories")
+    parser.add_argument('--processes', type=int, default=None,
+                        help="worker processes for rendering (default: one per core)")
+    args = parser.parse_args(argv)
+    jobs = []
+    for path in sorted(glob.glob(os.path.join(args.results, 'exp*'))):
+        if os.path.isdir(path):
+            jobs.extend(experiment_jobs(path))
+    pool = multiprocessing.Pool(args.processes)
+    try:
+        for filename in pool.imap_unordered(render, jobs):
+            print filename
+    finally:
+        pool.close()
+        pool.join()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+import types
+import copy_reg
+import cPickle as pickle
+from cache import write_atomic
+
+# Snapshots of a run in a kernel.Kernel. Everything a run is made of (the
+# pending events, the queues and checkpoint pointers of the ports, the pauses
+# sent and in flight, the random state of the generators, the monitor and its
+# trace writer) is plain Python state, so a snapshot is the pickle of it all.
+# The callbacks of the pending events are bound methods, which pickle as their
+# object and name. A run under SimPy can't be snapshotted, its processes are
+# live generators.
+
+def reduce_method(method):
+    return getattr, (method.im_self, method.im_func.__name__)
+
+copy_reg.pickle(types.MethodType, reduce_method)
+
+def save(filename, state):
+    """ Pickles state, a dict holding the kernel and the components of a run,
+        to filename. It is written through a temporary file, so being stopped
+        halfway leaves the previous snapshot in place.
+    """
+    write_atomic(filename, lambda f: pickle.dump(state, f, pickle.HIGHEST_PROTOCOL))
+
+def load(filename):
+    """ Returns the state saved in filename. A trace writer in it must be
+        reopen()ed before the run goes on.
+    """
+    with open(filename, 'rb') as f:
+        return pickle.load(f)
@@ -0,0 +1,132 @@
+import bisect
+import math
+
+# Constant memory statistics that can be read at any point of a simulation.
+
+class Histogram(object):
+    """ Exact counts of each distinct value of a stream. Memory grows with the
+        number of distinct values rather than the length of the stream, which
+        suits discrete data like queue sizes in bytes. Percentiles match
+        np.percentile with linear interpolation.
+    """
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def add(self, x, key=None):
+        """ Counts x, under key if given (what key(x) returns, to work it out once for several histograms) """
+        if key is None:
+            key = self.key(x)
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.count += 1
+        self.total += x
+        self.total_sq += x * x
+        if x < self.min:
+            self.min = x
+        if x > self.max:
+            self.max = x
+
+    def merge(self, other):
+        """ Adds the counts of another histogram of the same kind """
+        for key, count in other.counts.items():
+            self.counts[key] = self.counts.get(key, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.total_sq += other.total_sq
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def key(self, x):
+        return x
+
+    def to_dict(self):
+        """ Returns the state of the histogram as plain lists and numbers, e.g. for json """
+        return {'counts': sorted(self.counts.items()),
+                'count': self.count,
+                'total': self.total,
+                'total_sq': self.total_sq,
+                'min': self.min,
+                'max': self.max}
+
+    def load_dict(self, state):
+        """ Restores the state returned by to_dict() """
+        self.counts = dict((key, count) for key, count in state['counts'])
+        self.count = state['count']
+        self.total = state['total']
+        self.total_sq = state['total_sq']
+        self.min = state['min']
+        self.max = state['max']
+        return self
+
+    def value(self, key):
+        """ Returns the value that stands for all the values counted under key """
+        return key
+
+    def mean(self):
+        if not self.count:
+            return float('nan')
+        return self.total / self.count
+
+    def variance(self):
+        """ Returns the population variance, like np.var """
+        if not self.count:
+            return float('nan')
+        mean = self.total / self.count
+        return max(self.total_sq / self.count - mean * mean, 0.0)
+
+    def std(self):
+        return math.sqrt(self.variance())
+
+    def percentile(self, percentile):
+        if not self.count:
+            raise ValueError("no values recorded")
+        if percentile == 100:
+            return float(self.max)
+        if percentile == 0:
+            return float(self.min)
+        keys = sorted(self.counts)
+        cumulative = []
+        seen = 0
+        for key in keys:
+            seen += self.counts[key]
+            cumulative.append(seen)
+        rank = (percentile / 100.0) * (self.count - 1)
+        lo = int(math.floor(rank))
+        hi = min(lo + 1, self.count - 1)
+        weight = rank - lo
+        lo_value = self.value(keys[bisect.bisect_right(cumulative, lo)])
+        hi_value = self.value(keys[bisect.bisect_right(cumulative, hi)])
+        return lo_value * (1 - weight) + hi_value * weight
+
+class LogHistogram(Histogram):
+    """ A histogram of positive values with logarithmically spaced buckets,
+        in the style of an HDR histogram, for continuous data like delays.
+        Percentiles are within a relative error of precision; count, mean,
+        variance, min and max are exact.
+
+        Parameters
+        ----------
+        precision : float
+            relative width of a bucket
+    """
+    def __init__(self, precision=0.01):
+        Histogram.__init__(self)
+        self.precision = precision
+        self.log_base = math.log1p(precision)
+
+    def key(self, x):
+        if x <= 0:
+            # all non-positive values share the lowest bucket
+            return float('-inf')
+        return int(math.floor(math.log(x) / self.log_base))
+
+    def value(self, key):
+        if key == float('-inf'):
+            return self.min
+        # geometric middle of the bucket, kept inside what has been seen
+        value = math.exp((key + 0.5) * self.log_base)
+        return min(max(value, self.min), self.max)
@@ -0,0 +1,106 @@
+import math
+import numpy as np
+from stats import Histogram
+
+# Steady state mode of a simulation. Instead of running for sim_duration and
+# counting every sample, the run is checked every steady_check simulated
+# seconds: the warm-up from an empty queue is cut off the sampled queue sizes
+# with MSER-5, the rest is split into steady_batches batches, and the run stops
+# as soon as the confidence interval of the mean of the batch percentiles is
+# within steady_precision of it or within half a packet (a queue that is
+# nearly empty moves in whole packets), or at steady_max_duration.
+
+def mser(samples, batch=5):
+    """ Returns the number of samples to drop as warm-up, by MSER on the means
+        of consecutive batches of samples (MSER-5 by default). The cut is at
+        most half of the series.
+    """
+    means = np.asarray(samples[:len(samples) // batch * batch], dtype=float).reshape(-1, batch).mean(axis=1)
+    n = len(means)
+    if n < 2:
+        return 0
+    # sums over means[d:] for every d
+    total = means[::-1].cumsum()[::-1]
+    total_sq = (means ** 2)[::-1].cumsum()[::-1]
+    kept = np.arange(n, 0, -1, dtype=float)
+    scores = (total_sq - total ** 2 / kept) / kept ** 2
+    return batch * int(np.argmin(scores[:n // 2 + 1]))
+
+def normal_quantile(p):
+    """ Returns the p quantile of the standard normal distribution """
+    low, high = -40.0, 40.0
+    for i in range(100):
+        mid = (low + high) / 2
+        if 0.5 * math.erfc(-mid / math.sqrt(2)) < p:
+            low = mid
+        else:
+            high = mid
+    return (low + high) / 2
+
+def t_quantile(p, dof):
+    """ Returns the p quantile of Student's t distribution with dof degrees of
+        freedom, by the expansion of Abramowitz and Stegun 26.7.5
+    """
+    z = normal_quantile(p)
+    g1 = (z ** 3 + z) / 4
+    g2 = (5 * z ** 5 + 16 * z ** 3 + 3 * z) / 96
+    g3 = (3 * z ** 7 + 19 * z ** 5 + 17 * z ** 3 - 15 * z) / 384
+    g4 = (79 * z ** 9 + 776 * z ** 7 + 1482 * z ** 5 - 1920 * z ** 3 - 945 * z) / 92160
+    return z + g1 / dof + g2 / dof ** 2 + g3 / dof ** 3 + g4 / dof ** 4
+
+def batch_means(samples, batches, percentile, confidence):
+    """ Returns (mean, half width of its confidence interval) of the percentile
+        of samples over batches contiguous batches. The samples that don't
+        fill a batch are dropped from the front.
+    """
+    size = len(samples) // batches
+    batched = np.asarray(samples[len(samples) - size * batches:], dtype=float).reshape(batches, size)
+    values = np.percentile(batched, percentile, axis=1)
+    half_width = t_quantile(0.5 + confidence / 2, batches - 1) * values.std(ddof=1) / math.sqrt(batches)
+    return values.mean(), half_width
+
+def check(samples, config, min_batch=10):
+    """ Returns what the samples so far say about the steady state: the
+        warm-up cut off them, the estimate of config.percentile with its half
+        width, and whether that is within config.steady_precision of the
+        estimate or within half of config.packet_size.
+    """
+    warmup = mser(samples)
+    kept = len(samples) - warmup
+    result = {'warmup_samples': warmup,
+              'samples': kept,
+              'estimate': None,
+              'half_width': None,
+              'converged': False}
+    if kept < config.steady_batches * min_batch:
+        return result
+    estimate, half_width = batch_means(samples[warmup:], config.steady_batches, config.percentile,
+                                       config.steady_confidence)
+    # plain Python values, the result goes into the JSON summary of the cache
+    result['estimate'] = float(estimate)
+    result['half_width'] = float(half_width)
+    result['converged'] = bool(half_width <= max(config.steady_precision * estimate, config.packet_size / 2.0))
+    return result
+
+def run(advance, pm, config, until=None):
+    """ Runs a simulation in steady state mode. advance(until) must run it up
+        to until, and pm is its PortMonitor, keeping samples. The first check
+        is at until, by default after steady_check. The queue_stats of pm are
+        replaced by those of the samples after the warm-up. Returns the last
+        check() with the simulated duration and warm-up time added.
+    """
+    if until is None:
+        until = min(config.steady_check, config.steady_max_duration)
+    while True:
+        advance(until)
+        result = check(pm.queue_sizes, config)
+        if result['converged'] or until >= config.steady_max_duration:
+            break
+        until = min(until + config.steady_check, config.steady_max_duration)
+    samples = pm.queue_sizes[result['warmup_samples']:]
+    pm.queue_stats = Histogram()
+    for size in samples:
+        pm.queue_stats.add(size)
+    result['duration'] = until
+    result['warmup_time'] = result['warmup_samples'] * config.trace_rate
+    return result
@@ -0,0 +1,68 @@
+import numpy as np
+
+# Schedules of the pause thresholds of the pausing switch, in packets. A
+# schedule is a list like params.packet_thresholds: a resume threshold at every
+# even and a pause threshold at every odd entry, in ascending order, and
+# optionally the levels, one per pause threshold: the priority it pauses, or
+# None for the HRP of the queue at the resume threshold below it.
+#
+#   linear        every 2*B packets from first_pause * qlimit up to qlimit
+#   geometric     each threshold threshold_ratio times the one before
+#   per_priority  a pause and resume threshold for every priority but the
+#                 highest, evenly spaced, the n-th pause pausing priorities 0 to n
+#   file          read from threshold_file (see read_schedule())
+
+def linear(first, qlimit, B):
+    return range(first, qlimit, 2*B)
+
+def geometric(first, qlimit, ratio):
+    if ratio <= 1:
+        raise ValueError("a geometric schedule needs a ratio above 1, not {}".format(ratio))
+    count = int(np.ceil(np.log(float(qlimit) / max(first, 1)) / np.log(ratio)))
+    points = np.round(max(first, 1) * ratio ** np.arange(count)).astype(int)
+    return sorted(set(x for x in points.tolist() if x < qlimit))
+
+def per_priority(first, qlimit, num_priorities):
+    pairs = num_priorities - 1
+    points = np.round(np.linspace(first, qlimit, 2 * pairs, endpoint=False)).astype(int)
+    return points.tolist(), range(pairs)
+
+def read_schedule(filename):
+    """ Reads a schedule from a text file with one threshold in packets per
+        line, alternating resume and pause, and # comments. A pause line can
+        name the priority it pauses in a second column.
+    """
+    schedule = []
+    levels = []
+    with open(filename) as f:
+        for line in f:
+            fields = line.split('#')[0].split()
+            if not fields:
+                continue
+            value = float(fields[0])
+            schedule.append(int(value) if value.is_integer() else value)
+            if len(schedule) % 2 == 0:
+                levels.append(int(fields[1]) if len(fields) > 1 else None)
+            elif len(fields) > 1:
+                raise ValueError("{}: a resume threshold can't have a level: {}".format(filename, line.strip()))
+    if schedule != sorted(schedule):
+        raise ValueError("{}: thresholds must be in ascending order".format(filename))
+    if all(level is None for level in levels):
+        levels = None
+    return schedule, levels
+
+def schedule(config):
+    """ Returns (packet thresholds, pause levels) of config.threshold_schedule """
+    first = int(config.first_pause * config.qlimit)
+    name = config.threshold_schedule
+    if name == "linear":
+        return linear(first, config.qlimit, config.B), None
+    if name == "geometric":
+        return geometric(first, config.qlimit, config.threshold_ratio), None
+    if name == "per_priority":
+        return per_priority(first, config.qlimit, config.num_priorities)
+    if name == "file":
+        if config.threshold_file is None:
+            raise ValueError("a file schedule needs a threshold_file")
+        return read_schedule(config.threshold_file)
+    raise ValueError("unknown threshold schedule: {}".format(name))
@@ -0,0 +1,225 @@
+import time
+import argparse
+import simpy
+import numpy as np
+from collections import deque
+from model import MergedPacketGenerator, PacketSink, PrioritySwitchPort
+from stats import LogHistogram
+
+class Switch(object):
+    """ A switch made of one pausing PrioritySwitchPort toward each neighbor and a
+        routing table. A packet put into the switch goes to the output port toward
+        its destination; if there are several equal-cost next hops one is picked
+        by hashing the flow, so a flow always takes the same path.
+
+        Members
+        -------
+        ports : dict
+            neighbor id -> output port toward that neighbor
+        routes : dict
+            destination host id -> list of next hop neighbor ids
+        ingress : list
+            the ports that send into this switch; every output port of the
+            switch sends its pauses and resumes to all of them
+    """
+    def __init__(self, id):
+        self.id = id
+        self.ports = {}
+        self.routes = {}
+        self.ingress = []
+
+    def put(self, pkt):
+        hops = self.routes[pkt.dst]
+        if len(hops) > 1:
+            hop = hops[hash((pkt.src, pkt.flow_id, self.id)) % len(hops)]
+        else:
+            hop = hops[0]
+        self.ports[hop].put(pkt)
+
+class Host(object):
+    """ An end host: a NIC port with an unlimited queue toward its switch, which
+        obeys pauses from the switch, and a sink for the packets it receives.
+    """
+    def __init__(self, env, id, rate):
+        self.id = id
+        self.switch = None
+        self.nic = PrioritySwitchPort(env, rate, qlimit=None, pause=False)
+        self.sink = PacketSink(env)
+        self.generator = None
+
+    def put(self, pkt):
+        self.nic.put(pkt)
+
+class Fabric(object):
+    """ A network of switches and hosts built from a params.SimulationConfig.
+        Every link is output_rate in each direction and every switch output
+        port pauses with the checkpoints of the config, so congestion is pushed
+        back hop by hop toward the hosts.
+
+        Add switches, hosts and links, then call build_routes() and add_traffic().
+    """
+    def __init__(self, env, config):
+        self.env = env
+        self.config = config
+        self.switches = {}
+        self.hosts = {}
+        self.links = {}  # switch id -> ids of the neighboring switches
+        self.ports = []  # every switch output port
+        self.block_size = 256  # arrivals drawn at a time per host, small to keep memory down
+
+    def add_switch(self, id):
+        self.switches[id] = Switch(id)
+        self.links[id] = []
+        return self.switches[id]
+
+    def add_host(self, id, switch_id):
+        switch = self.switches[switch_id]
+        host = Host(self.env, id, self.config.output_rate)
+        host.switch = switch_id
+        host.nic.out = switch
+        switch.ingress.append(host.nic)
+        port = self.make_port(switch)
+        port.out = host.sink
+        switch.ports[id] = port
+        self.hosts[id] = host
+        return host
+
+    def connect(self, a, b):
+        for src, dst in ((a, b), (b, a)):
+            port = self.make_port(self.switches[src])
+            port.out = self.switches[dst]
+            self.switches[src].ports[dst] = port
+            self.switches[dst].ingress.append(port)
+            self.links[src].append(dst)
+
+    def make_port(self, switch):
+        port = PrioritySwitchPort(self.env, rate=self.config.output_rate, pause=True)
+        port.configure(self.config)
+        port.back = switch.ingress
+        self.ports.append(port)
+        return port
+
+    def build_routes(self):
+        """ Fills in the routing tables with every shortest path next hop """
+        hosts_at = {}
+        for host in self.hosts.values():
+            hosts_at.setdefault(host.switch, []).append(host.id)
+        for edge, host_ids in hosts_at.items():
+            # hop counts from every switch to this edge switch
+            dist = {edge: 0}
+            frontier = deque([edge])
+            while frontier:
+                s = frontier.popleft()
+                for n in self.links[s]:
+                    if n not in dist:
+                        dist[n] = dist[s] + 1
+                        frontier.append(n)
+            for s, switch in self.switches.items():
+                if s == edge:
+                    for h in host_ids:
+                        switch.routes[h] = [h]
+                elif s in dist:
+                    hops = [n for n in self.links[s] if dist.get(n) == dist[s] - 1]
+                    for h in host_ids:
+                        switch.routes[h] = hops
+
+    def add_traffic(self, seed=0):
+        """ Gives every host Poisson traffic at load k of its link over the
+            config's priorities, each burst to a uniformly chosen other host.
+        """
+        c = self.config
+        rng = np.random.RandomState(seed)
+        host_ids = sorted(self.hosts)
+        for host_id in host_ids:
+            host = self.hosts[host_id]
+            others = [h for h in host_ids if h != host_id]
+            host.generator = MergedPacketGenerator(self.env, [host_id] * len(c.priorities), c.priorities, c.burst_size,
+                                                   c.burst_interval, lambda n: [c.packet_size] * n, rng,
+                                                   block_size=self.block_size, flow_ids=c.priorities, dsts=others)
+            host.generator.out = host
+
+    def run(self, duration):
+        while self.env.peek() < duration:
+            self.env.step()
+
+    def summary(self):
+        waits = LogHistogram()
+        for host in self.hosts.values():
+            waits.merge(host.sink.wait_stats)
+        return {'switches': len(self.switches),
+                'hosts': len(self.hosts),
+                'ports': len(self.ports),
+                'packets_delivered': sum(host.sink.packets_rec for host in self.hosts.values()),
+                'packets_drop': sum(port.packets_drop for port in self.ports),
+                'ports_paused': sum(1 for port in self.ports if port.pause_rec),
+                'nics_paused': sum(1 for host in self.hosts.values() if host.nic.pause_rec),
+                'max_queue': max(port.byte_size for port in self.ports),
+                'mean_delay': waits.mean(),
+                'p99_delay': waits.percentile(99.0) if waits.count else float('nan')}
+
+def leaf_spine(env, config, leaves, spines, hosts_per_leaf):
+    """ Every leaf connects to every spine and to hosts_per_leaf hosts """
+    fabric = Fabric(env, config)
+    for s in range(spines):
+        fabric.add_switch('spine{}'.format(s))
+    for l in range(leaves):
+        leaf = 'leaf{}'.format(l)
+        fabric.add_switch(leaf)
+        for s in range(spines):
+            fabric.connect(leaf, 'spine{}'.format(s))
+        for h in range(hosts_per_leaf):
+            fabric.add_host('h{}'.format(l * hosts_per_leaf + h), leaf)
+    fabric.build_routes()
+    return fabric
+
+def fat_tree(env, config, k):
+    """ A k-ary fat tree: k pods of k/2 edge and k/2 aggregation switches,
+        (k/2)^2 core switches and k/2 hosts per edge switch.
+    """
+    half = k // 2
+    fabric = Fabric(env, config)
+    for c in range(half * half):
+        fabric.add_switch('core{}'.format(c))
+    for p in range(k):
+        for a in range(half):
+            agg = 'agg{}_{}'.format(p, a)
+            fabric.add_switch(agg)
+            for c in range(a * half, (a + 1) * half):
+                fabric.connect(agg, 'core{}'.format(c))
+        for e in range(half):
+            edge = 'edge{}_{}'.format(p, e)
+            fabric.add_switch(edge)
+            for a in range(half):
+                fabric.connect(edge, 'agg{}_{}'.format(p, a))
+            for h in range(half):
+                fabric.add_host('h{}_{}_{}'.format(p, e, h), edge)
+    fabric.build_routes()
+    return fabric
+
+def main(argv=None):
+    from generate import parse_config_args
+    parser = argparse.ArgumentParser(description="Simulate a lossless pFabric switch fabric.",
+                                     epilog="Any name=value argument after the topology, among the options or after them, "
+                                            "overrides a parameter from params.py, e.g. k=0.5 num_priorities=10.")
+    parser.add_argument('topology', choices=['leaf-spine', 'fat-tree'])
+    parser.add_argument('--leaves', type=int, default=4)
+    parser.add_argument('--spines', type=int, default=2)
+    parser.add_argument('--hosts-per-leaf', type=int, default=4)
+    parser.add_argument('--arity', type=int, default=4, help="arity of the fat tree")
+    parser.add_argument('--seed', type=int, default=0)
+    args, config = parse_config_args(parser, argv)
+    env = simpy.Environment()
+    if args.topology == 'leaf-spine':
+        fabric = leaf_spine(env, config, args.leaves, args.spines, args.hosts_per_leaf)
+    else:
+        fabric = fat_tree(env, config, args.arity)
+    fabric.add_traffic(args.seed)
+    start = time.time()
+    fabric.run(config.sim_duration)
+    summary = fabric.summary()
+    summary['wall_time'] = time.time() - start
+    for name in sorted(summary):
+        print "{}: {}".format(name, summary[name])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,326 @@
+import struct
+import sys
+import numpy as np
+import params
+
+# Trace rows hold: time byte_size makeups largest_pause_sent packet_drops
+# In a binary trace these are the fields of a structured NumPy array, written
+# to a .npy file that can be opened with np.load(..., mmap_mode='r').
+# Queue bytes are bounded by qlimit * packet_size, so the counts fit in 32 bits
+# and a binary trace stays smaller than the text one.
+
+HEADER_ALIGN = 64
+
+def trace_dtype(num_priorities):
+    return np.dtype([('time', '<f8'),
+                     ('byte_size', '<i4'),
+                     ('makeup', '<i4', (num_priorities,)),
+                     ('pause', '<i4'),
+                     ('drops', '<i4')])
+
+class NpyTraceWriter(object):
+    """ Collects trace samples into a preallocated structured array and
+        appends it to a .npy file whenever it fills up. The header is
+        rewritten on every flush, so the file is always loadable.
+
+        Parameters
+        ----------
+        filename : string
+            the .npy file to write
+        num_priorities : int
+            number of priority levels in the queue makeup
+        chunk_size : int
+            number of samples buffered between writes to disk
+        dtype : numpy.dtype
+            the rows to write instead of trace rows, with write_rows()
+
+        A writer can be pickled, which flushes it. An unpickled one must be
+        reopen()ed before it is written to.
+    """
+    def __init__(self, filename, num_priorities, chunk_size=4096, dtype=None):
+        self.filename = filename
+        self.dtype = dtype if dtype is not None else trace_dtype(num_priorities)
+        self.chunk_size = chunk_size
+        self.buffer = np.zeros(chunk_size, dtype=self.dtype)
+        self.pending = 0
+        self.rows = 0
+        # leave room in the header for any row count
+        self.header_len = len(self.header(10**20)) + 1
+        self.header_len += -(self.header_len + 10) % HEADER_ALIGN
+        self.file = open(filename, 'wb')
+        self.write_header()
+
+    def header(self, rows):
+        return repr({'descr': np.lib.format.dtype_to_descr(self.dtype),
+                     'fortran_order': False,
+                     'shape': (rows,)})
+
+    def write_header(self):
+        header = self.header(self.rows).ljust(self.header_len - 1) + '\n'
+        self.file.seek(0)
+        self.file.write(np.lib.format.magic(1, 0))
+        self.file.write(struct.pack('<H', self.header_len))
+        self.file.write(header.encode('latin1'))
+        self.file.seek(0, 2)
+
+    def write(self, now, byte_size, makeup, pause, drops):
+        self.buffer[self.pending] = (now, byte_size, makeup, pause, drops)
+        self.pending += 1
+        if self.pending == len(self.buffer):
+            self.flush()
+
+    def write_rows(self, rows):
+        """ Appends a structured array of rows of the dtype of the writer """
+        self.flush()
+        self.file.write(np.ascontiguousarray(rows, dtype=self.dtype).tobytes())
+        self.rows += len(rows)
+        self.write_header()
+
+    def flush(self):
+        if self.pending:
+            self.file.write(self.buffer[:self.pending].tobytes())
+            self.rows += self.pending
+            self.pending = 0
+            self.write_header()
+        self.file.flush()
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+    def __getstate__(self):
+        self.flush()
+        state = dict(self.__dict__)
+        del state['file'], state['buffer']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.buffer = np.zeros(self.chunk_size, dtype=self.dtype)
+        self.file = None
+
+    def reopen(self, filename=None):
+        """ Goes on with a trace restored from a snapshot, in its own file cut
+            back to the snapshot, or in filename, which gets a copy of the trace
+            up to the snapshot.
+        """
+        # magic string and header length, header, rows
+        size = 10 + self.header_len + self.rows * self.dtype.itemsize
+        if filename is not None and filename != self.filename:
+            copy_prefix(self.filename, filename, size)
+            self.filename = filename
+        self.file = open(self.filename, 'r+b')
+        self.file.truncate(size)
+        self.write_header()
+
+class TsvTraceWriter(object):
+    """ Writes trace samples as delimited text, one line per sample. Pickles
+        like an NpyTraceWriter.
+    """
+    def __init__(self, filename, num_priorities, delim=params.trace_delim):
+        self.filename = filename
+        self.delim = delim
+        self.file = open(filename, 'w')
+
+    def write(self, now, byte_size, makeup, pause, drops):
+        fields = [str(now), str(byte_size)]
+        fields.extend([str(x) for x in makeup])
+        fields.append(str(pause))
+        fields.append(str(drops))
+        self.file.write(self.delim.join(fields))
+        self.file.write("\n")
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __getstate__(self):
+        self.flush()
+        state = dict(self.__dict__)
+        state['size'] = self.file.tell()
+        del state['file']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.file = None
+
+    def reopen(self, filename=None):
+        if filename is not None and filename != self.filename:
+            copy_prefix(self.filename, filename, self.size)
+            self.filename = filename
+        self.file = open(self.filename, 'r+')
+        self.file.truncate(self.size)
+        self.file.seek(0, 2)
+
+def copy_prefix(source, destination, size, chunk_bytes=2**20):
+    """ Copies the first size bytes of the file source to destination """
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        while size > 0:
+            chunk = src.read(min(size, chunk_bytes))
+            if not chunk:
+                break
+            dst.write(chunk)
+            size -= len(chunk)
+
+def open_trace(filename, num_priorities, delim=params.trace_delim):
+    """ Returns a trace writer, binary for .npy files and text otherwise """
+    if filename.endswith('.npy'):
+        return NpyTraceWriter(filename, num_priorities)
+    return TsvTraceWriter(filename, num_priorities, delim)
+
+def is_binary(filename):
+    with open(filename, 'rb') as f:
+        return f.read(6) == np.lib.format.magic(1, 0)[:6]
+
+def table_to_trace(text):
+    """ Converts the columns of a text trace to the structured trace array """
+    data = np.zeros(len(text), dtype=trace_dtype(text.shape[1] - 4))
+    data['time'] = text[:, 0]
+    data['byte_size'] = text[:, 1]
+    data['makeup'] = text[:, 2:-2]
+    data['pause'] = text[:, -2]
+    data['drops'] = text[:, -1]
+    return data
+
+def load_trace(filename, delim=params.trace_delim):
+    """ Loads a trace as a structured array. Binary traces are memory-mapped,
+        text traces are parsed and converted.
+    """
+    if is_binary(filename):
+        return np.load(filename, mmap_mode='r')
+    return table_to_trace(np.loadtxt(filename, delimiter=delim, ndmin=2))
+
+def trace_chunks(filename, delim=params.trace_delim, chunk_bytes=2**26, first=0, stop=None):
+    """ Yields (number of the first row, structured array) for successive pieces
+        of a trace of about chunk_bytes each, so a trace of any length can be
+        read in bounded memory. A binary trace is read from row first to
+        row stop (the end if None), a text trace always from the start.
+    """
+    if is_binary(filename):
+        data = np.load(filename, mmap_mode='r')
+        rows = max(1, chunk_bytes // data.dtype.itemsize)
+        if stop is None:
+            stop = len(data)
+        with open(filename, 'rb') as f:
+            f.seek(data.offset + first * data.dtype.itemsize)
+            for i in range(first, stop, rows):
+                yield i, np.fromfile(f, dtype=data.dtype, count=min(rows, stop - i))
+        return
+    first = 0
+    with open(filename) as f:
+        while True:
+            lines = f.readlines(chunk_bytes)
+            if not lines:
+                break
+            columns = len(lines[0].split(delim))
+            values = np.fromstring(''.join(lines).replace(delim, ' '), sep=' ')
+            chunk = table_to_trace(values.reshape(-1, columns))
+            yield first, chunk
+            first += len(chunk)
+
+def search_time(data, t):
+    """ Returns the first row of a trace at or after time t, by bisection so a
+        memory-mapped trace is only touched at a few rows.
+    """
+    lo, hi = 0, len(data)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if data[mid]['time'] < t:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+def last_time(filename, delim=params.trace_delim):
+    """ Returns the time of the last sample of a text trace without reading all of it """
+    with open(filename, 'rb') as f:
+        f.seek(0, 2)
+        size = f.tell()
+        f.seek(max(0, size - 2**20))
+        lines = f.read().splitlines()
+    return float(lines[-1].split(delim)[0])
+
+def decimate_trace(filename, width, start=None, end=None, delim=params.trace_delim, chunk_bytes=2**26):
+    """ Loads the envelope of a trace between times start and end (the whole
+        trace if None) for a plot width pixels wide. The window is split into
+        width equal bins, and every bin with samples in it gives two rows at
+        the time of its first sample: the smallest and then the largest value
+        of every field in the bin, each makeup column on its own, so peaks in
+        any priority stay visible. Returns at most 2 * width rows as a
+        structured array of the trace's dtype.
+        The trace is streamed in chunks, and only the window of a binary trace
+        is read.
+    """
+    binary = is_binary(filename)
+    if binary:
+        data = np.load(filename, mmap_mode='r')
+        if not len(data):
+            return np.array(data)
+        first = search_time(data, start) if start is not None else 0
+        stop = search_time(data, np.nextafter(end, np.inf)) if end is not None else len(data)
+        if start is None:
+            start = data[0]['time']
+        if end is None:
+            end = data[-1]['time']
+        chunks = trace_chunks(filename, delim, chunk_bytes, first, stop)
+    else:
+        if start is None:
+            with open(filename) as f:
+                start = float(f.readline().split(delim)[0])
+        if end is None:
+            end = last_time(filename, delim)
+        chunks = trace_chunks(filename, delim, chunk_bytes)
+    span = float(end - start) or 1.0
+    low = high = None
+    seen = np.zeros(width, dtype=bool)
+    for offset, chunk in chunks:
+        times = np.asarray(chunk['time'])
+        if not binary:
+            if times[0] > end:
+                break
+            chunk = chunk[(times >= start) & (times <= end)]
+            times = chunk['time']
+        if not len(chunk):
+            continue
+        if low is None:
+            low = np.zeros(width, dtype=chunk.dtype)
+            high = np.zeros(width, dtype=chunk.dtype)
+        bins = np.minimum(((times - start) / span * width).astype(np.int64), width - 1)
+        # the samples are in time order, so each bin is one run of rows
+        heads = np.flatnonzero(np.r_[True, np.diff(bins) != 0])
+        where = bins[heads]
+        new = ~seen[where]
+        low['time'][where[new]] = high['time'][where[new]] = times[heads[new]]
+        for field in ('byte_size', 'makeup', 'pause', 'drops'):
+            values = np.asarray(chunk[field])
+            smallest = np.minimum.reduceat(values, heads, axis=0)
+            largest = np.maximum.reduceat(values, heads, axis=0)
+            old = ~new
+            smallest[old] = np.minimum(smallest[old], low[field][where[old]])
+            largest[old] = np.maximum(largest[old], high[field][where[old]])
+            low[field][where] = smallest
+            high[field][where] = largest
+        seen[where] = True
+    if low is None:
+        return np.zeros(0, dtype=data.dtype if binary else trace_dtype(0))
+    envelope = np.zeros(2 * seen.sum(), dtype=low.dtype)
+    envelope[0::2] = low[seen]
+    envelope[1::2] = high[seen]
+    return envelope
+
+def export_tsv(src, dst, delim=params.trace_delim):
+    """ Writes a trace out in the tab separated text format """
+    data = load_trace(src)
+    out = TsvTraceWriter(dst, data.dtype['makeup'].shape[0], delim)
+    for row in data:
+        out.write(float(row['time']), int(row['byte_size']), row['makeup'].tolist(),
+                  int(row['pause']), int(row['drops']))
+    out.close()
+
+if __name__ == '__main__':
+    # python traces.py queue.npy queue.tr
+    export_tsv(sys.argv[1], sys.argv[2])
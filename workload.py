@@ -0,0 +1,162 @@
+import argparse
+import numpy as np
+import params
+import traces
+
+# Workloads to replay instead of the Poisson bursts. A workload file is a .npy
+# file of packets in order of time, a structured NumPy array with the fields
+#
+#   time       arrival time in seconds from the start of the workload
+#   size       packet size in bytes
+#   flow       the flow the packet belongs to
+#   remaining  bytes of its flow not yet sent, this packet included
+#
+# It can be a recorded packet trace converted to this format, or made by this
+# module from a flow size CDF: flows arrive as a Poisson process for a given
+# load, each sends its packets back to back at input_rate. A
+# model.WorkloadPacketGenerator replays a workload from a memory map a block
+# at a time, giving every packet a priority from the remaining size of its
+# flow like pFabric does, so a workload of any length fits in memory.
+#
+#   python workload.py websearch web.npy [--load 0.9] [--duration 2.0] [--seed 0]
+#   python workload.py flows.cdf flows.npy ...
+
+WORKLOAD_DTYPE = np.dtype([('time', '<f8'),
+                           ('size', '<i8'),
+                           ('flow', '<i8'),
+                           ('remaining', '<i8')])
+
+# (flow size in packets, cumulative probability) of the web search and data
+# mining workloads used in the pFabric simulations
+WEB_SEARCH = [(6, 0.0), (6, 0.15), (13, 0.2), (19, 0.3), (33, 0.4), (53, 0.53), (133, 0.6), (667, 0.7),
+              (1333, 0.8), (3333, 0.9), (6667, 0.97), (20000, 1.0)]
+DATA_MINING = [(1, 0.0), (1, 0.5), (2, 0.6), (3, 0.7), (7, 0.8), (267, 0.9), (2107, 0.95), (66667, 0.99),
+               (666667, 1.0)]
+CDFS = {'websearch': WEB_SEARCH, 'datamining': DATA_MINING}
+
+def read_cdf(filename):
+    """ Reads a flow size CDF from a text file in the format of the ns-2
+        simulations: a flow size in packets first and its cumulative
+        probability last on every line.
+    """
+    cdf = []
+    with open(filename) as f:
+        for line in f:
+            fields = line.split('#')[0].split()
+            if fields:
+                cdf.append((float(fields[0]), float(fields[-1])))
+    return cdf
+
+class FlowSizes(object):
+    """ Draws flow sizes in packets from a CDF given as (size, cumulative
+        probability) points, interpolating linearly between them like ns-2's
+        EmpiricalRandomVariable.
+    """
+    def __init__(self, cdf, rng):
+        self.sizes = np.array([size for size, p in cdf], dtype=float)
+        self.probabilities = np.array([p for size, p in cdf], dtype=float)
+        if np.any(np.diff(self.probabilities) < 0) or self.probabilities[-1] != 1.0:
+            raise ValueError("not a CDF: {}".format(cdf))
+        self.rng = rng
+
+    def mean(self):
+        """ Returns the mean flow size in packets, before rounding up """
+        steps = np.diff(self.probabilities)
+        return float(np.sum(steps * (self.sizes[1:] + self.sizes[:-1]) / 2)) + self.sizes[0] * self.probabilities[0]
+
+    def draw(self, n):
+        values = np.interp(self.rng.uniform(0, 1, n), self.probabilities, self.sizes)
+        return np.maximum(np.ceil(values), 1).astype(np.int64)
+
+def flow_packets(starts, counts, first_flow, packet_size, gap):
+    """ Returns the packets of flows starting at starts with counts packets
+        each, numbered from first_flow, as rows of WORKLOAD_DTYPE in flow order.
+    """
+    total = int(counts.sum())
+    rows = np.zeros(total, dtype=WORKLOAD_DTYPE)
+    flow = np.repeat(np.arange(len(counts)), counts)
+    offset = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    rows['time'] = starts[flow] + offset * gap
+    rows['size'] = packet_size
+    rows['flow'] = first_flow + flow
+    rows['remaining'] = (counts[flow] - offset) * packet_size
+    return rows
+
+def write_workload(filename, cdf, load, duration, seed=0, packet_size=params.packet_size,
+                   output_rate=params.output_rate, input_rate=params.input_rate, block_size=4096):
+    """ Writes a workload of flows arriving until duration with sizes drawn from
+        cdf, Poisson at the rate that loads output_rate to load. The flows are
+        drawn block_size at a time and their packets merged in order of time,
+        keeping only those that a later flow could still come before.
+        Returns the number of flows and of packets.
+    """
+    rng = np.random.RandomState(seed)
+    sizes = FlowSizes(cdf, rng)
+    mean_gap = sizes.mean() * packet_size * 8 / (load * output_rate)
+    gap = packet_size * 8.0 / input_rate
+    out = traces.NpyTraceWriter(filename, None, dtype=WORKLOAD_DTYPE)
+    pending = np.zeros(0, dtype=WORKLOAD_DTYPE)
+    now = 0.0
+    flows = 0
+    try:
+        while True:
+            starts = now + np.cumsum(rng.exponential(mean_gap, block_size))
+            now = starts[-1]
+            starts = starts[starts < duration]
+            counts = sizes.draw(len(starts))
+            pending = np.concatenate([pending, flow_packets(starts, counts, flows, packet_size, gap)])
+            pending = pending[np.argsort(pending['time'], kind='mergesort')]
+            flows += len(starts)
+            if now >= duration:
+                out.write_rows(pending)
+                break
+            # the flows still to come start after now
+            ready = np.searchsorted(pending['time'], now, side='right')
+            out.write_rows(pending[:ready])
+            pending = pending[ready:]
+        return flows, out.rows
+    finally:
+        out.close()
+
+def open_workload(filename):
+    """ Returns the packets of a workload file, memory-mapped """
+    data = np.load(filename, mmap_mode='r')
+    if data.dtype != WORKLOAD_DTYPE:
+        raise ValueError("{} is not a workload: its fields are {}".format(filename, data.dtype))
+    return data
+
+def priority_edges(data, num_priorities, chunk_rows=2**20):
+    """ Returns the remaining flow sizes that separate num_priorities priority
+        levels, evenly spaced on a log scale over the remaining sizes in data,
+        which is read chunk_rows at a time.
+    """
+    if not len(data):
+        return np.zeros(0)
+    low, high = float("inf"), 0
+    for start in range(0, len(data), chunk_rows):
+        remaining = np.asarray(data[start:start + chunk_rows]['remaining'])
+        low = min(low, remaining.min())
+        high = max(high, remaining.max())
+    return np.geomspace(low, high, num_priorities + 1)[1:-1]
+
+def priorities(remaining, edges):
+    """ Returns the priority of packets with remaining flow sizes: the
+        highest, len(edges), up to edges[0] bytes left, down to 0 for the largest.
+    """
+    return len(edges) - np.searchsorted(edges, remaining)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Make a workload file from a flow size CDF.")
+    parser.add_argument('cdf', help="websearch, datamining or a CDF file")
+    parser.add_argument('output', help="the .npy workload file to write")
+    parser.add_argument('--load', type=float, default=params.k, help="load of the output link (default: k)")
+    parser.add_argument('--duration', type=float, default=params.sim_duration,
+                        help="seconds during which flows arrive (default: sim_duration)")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    cdf = CDFS[args.cdf] if args.cdf in CDFS else read_cdf(args.cdf)
+    flows, packets = write_workload(args.output, cdf, args.load, args.duration, args.seed)
+    print "{} flows, {} packets".format(flows, packets)
+
+if __name__ == '__main__':
+    main()